@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# BM25 retrieval baseline for subtasks B and C.
+#
+# `build` indexes the reasons of train.csv (Right Reason1-3, Confusing Reason1-2)
+# into a single compact file: a sorted vocabulary, per-term posting lists of
+# document ids with precomputed BM25 impacts (sorted by impact), and the reason
+# texts. `predict` memory-maps that file and answers a whole data file in one
+# batch, writing a submission file that evaluate.py accepts.
+#
+# Subtask B: every option is scored by the right/confusing label of the training
+# reasons it retrieves (query = FalseSent + option), the highest scoring option wins.
+# Subtask C: the nearest training right reason to FalseSent is returned.
+
+from typing import Dict, List, Optional, Set, Tuple
+from operator import itemgetter
+import argparse
+import array
+import collections
+import csv
+import heapq
+import logging
+import math
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from section_file import read_sections, write_sections  # noqa: E402
+
+
+EXIT_STATUS_DATA_MALFORMED = 1
+EXIT_STATUS_INDEX_MALFORMED = 2
+
+COMBINED_HEADER = ['Correct Statement', 'Incorrect Statement', 'Right Reason1',
+                   'Confusing Reason1', 'Confusing Reason2', 'Right Reason2', 'Right Reason3']
+# column of train.csv -> is it a right reason
+REASON_COLUMNS = {2: True, 3: False, 4: False, 5: True, 6: True}
+
+INDEX_MAGIC = b'BM25IDX1\n'
+
+WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return WORD_RE.findall(text.lower())
+
+
+def build_index(train_file: str, index_file: str, k1: float = 1.2, b: float = 0.75,
+                max_df: float = 0.1):
+    """Indexes every reason of `train_file` and writes the index to `index_file`.
+    Terms occurring in more than `max_df` of the reasons are treated as stop words."""
+    texts = []
+    kinds = array.array('B')
+    lengths = []
+    term_freqs = []
+    with open(train_file, "rt", encoding="UTF-8", errors="replace") as f:
+        reader = csv.reader(f)
+        try:
+            header = next(reader, None)
+            if header != COMBINED_HEADER:
+                logging.error("Unexpected header %s in %s", header, train_file)
+                sys.exit(EXIT_STATUS_DATA_MALFORMED)
+            for row in reader:
+                if len(row) != len(COMBINED_HEADER):
+                    logging.error("Expected %d fields in %s on line %d, found %d",
+                                  len(COMBINED_HEADER), train_file, reader.line_num, len(row))
+                    sys.exit(EXIT_STATUS_DATA_MALFORMED)
+                for column, right in REASON_COLUMNS.items():
+                    tokens = tokenize(row[column])
+                    if not tokens:
+                        continue
+                    texts.append(' '.join(row[column].split()))
+                    kinds.append(right)
+                    lengths.append(len(tokens))
+                    term_freqs.append(collections.Counter(tokens))
+        except csv.Error as e:
+            logging.error('file %s, line %d: %s', train_file, reader.line_num, e)
+            sys.exit(EXIT_STATUS_DATA_MALFORMED)
+
+    num_docs = len(texts)
+    avgdl = sum(lengths) / num_docs
+
+    postings = collections.defaultdict(list)
+    for doc, counts in enumerate(term_freqs):
+        norm = k1 * (1 - b + b * lengths[doc] / avgdl)
+        for term, tf in counts.items():
+            postings[term].append((tf * (k1 + 1) / (tf + norm), doc))
+
+    vocab = sorted(term for term, plist in postings.items() if len(plist) <= max_df * num_docs)
+    offsets = array.array('I', [0])
+    docs = array.array('I')
+    impacts = array.array('f')
+    idfs = array.array('f')
+    for term in vocab:
+        plist = sorted(postings[term], reverse=True)
+        df = len(plist)
+        idfs.append(math.log(1 + (num_docs - df + 0.5) / (df + 0.5)))
+        impacts.extend(impact for impact, _ in plist)
+        docs.extend(doc for _, doc in plist)
+        offsets.append(len(docs))
+
+    sections = [
+        ('offsets', offsets), ('docs', docs), ('impacts', impacts), ('idfs', idfs), ('kinds', kinds),
+        ('vocab', '\n'.join(vocab).encode('utf-8')), ('texts', '\n'.join(texts).encode('utf-8')),
+    ]
+    write_sections(index_file, INDEX_MAGIC,
+                   {'k1': k1, 'b': b, 'num_docs': num_docs, 'avgdl': avgdl}, sections)
+    logging.info("Indexed %d reasons, %d terms", num_docs, len(vocab))
+
+
+class BM25Index(object):
+    """Read-only view of an index file written by `build_index`."""
+
+    def __init__(self, index_file: str):
+        try:
+            self._mapped = read_sections(index_file, INDEX_MAGIC)
+        except ValueError:
+            logging.error("%s is not a BM25 index", index_file)
+            sys.exit(EXIT_STATUS_INDEX_MALFORMED)
+        self.num_docs = self._mapped.header['num_docs']
+
+        sections = self._mapped.sections
+        self.offsets = sections['offsets']
+        self.docs = sections['docs']
+        self.impacts = sections['impacts']
+        self.idfs = sections['idfs']
+        self.kinds = sections['kinds']
+        self.term_ids = {term: i for i, term in
+                         enumerate(bytes(sections['vocab']).decode('utf-8').split('\n'))}
+        self.texts = bytes(sections['texts']).decode('utf-8').split('\n')
+
+    def accumulate(self, terms: Set[str], depth: int, scores: Optional[Dict[int, float]] = None,
+                   right_only: bool = False) -> Dict[int, float]:
+        """Adds the BM25 contribution of every term in `terms` to `scores`.
+        Posting lists are impact-ordered, so only their first `depth` entries
+        are visited."""
+        if scores is None:
+            scores = {}
+        get = scores.get
+        kinds = self.kinds
+        for term in terms:
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            idf = self.idfs[term_id]
+            start = self.offsets[term_id]
+            stop = min(self.offsets[term_id + 1], start + depth)
+            for doc, impact in zip(self.docs[start:stop], self.impacts[start:stop]):
+                if right_only and not kinds[doc]:
+                    continue
+                scores[doc] = get(doc, 0.0) + idf * impact
+        return scores
+
+    def search_batch(self, queries: List[str], k: int, depth: int,
+                     right_only: bool = False) -> List[List[Tuple[int, float]]]:
+        """Returns the top `k` (doc, score) pairs for every query."""
+        return [top_k(self.accumulate(set(tokenize(query)), depth, right_only=right_only), k)
+                for query in queries]
+
+    def close(self):
+        self._mapped.close()
+
+
+def top_k(scores: Dict[int, float], k: int) -> List[Tuple[int, float]]:
+    return heapq.nlargest(k, scores.items(), key=itemgetter(1))
+
+
+def read_data(filename: str, width: int) -> List[List[str]]:
+    rows = []
+    with open(filename, "rt", encoding="UTF-8", errors="replace") as f:
+        reader = csv.reader(f)
+        try:
+            next(reader, None)
+            for row in reader:
+                if len(row) < width:
+                    logging.error("Expected %d fields in %s on line %d, found %d",
+                                  width, filename, reader.line_num, len(row))
+                    sys.exit(EXIT_STATUS_DATA_MALFORMED)
+                rows.append(row)
+        except csv.Error as e:
+            logging.error('file %s, line %d: %s', filename, reader.line_num, e)
+            sys.exit(EXIT_STATUS_DATA_MALFORMED)
+    return rows
+
+
+def predict_taskB(index: BM25Index, rows: List[List[str]], k: int, depth: int) -> Dict[str, str]:
+    predictions = {}
+    for row in rows:
+        # the three queries of an instance share FalseSent, accumulate it once
+        statement_terms = set(tokenize(row[1]))
+        statement_scores = index.accumulate(statement_terms, depth)
+        option_scores = []
+        for option in row[2:5]:
+            scores = index.accumulate(set(tokenize(option)) - statement_terms, depth,
+                                      dict(statement_scores))
+            hits = top_k(scores, k)
+            total = sum(score for _, score in hits)
+            right = sum(score for doc, score in hits if index.kinds[doc])
+            option_scores.append(right / total if total > 0 else 0.0)
+        predictions[row[0]] = 'ABC'[option_scores.index(max(option_scores))]
+    return predictions
+
+
+def predict_taskC(index: BM25Index, rows: List[List[str]], k: int, depth: int) -> Dict[str, str]:
+    results = index.search_batch([row[1] for row in rows], k, depth, right_only=True)
+
+    predictions = {}
+    for row, hits in zip(rows, results):
+        predictions[row[0]] = index.texts[hits[0][0]] if hits else ''
+    return predictions
+
+
+def write_predictions(filename: str, predictions: Dict[str, str]):
+    with open(filename, "wt", encoding="UTF-8", newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        for instance_id, prediction in predictions.items():
+            writer.writerow([instance_id, prediction])
+
+
+def main():
+    if args.command == 'build':
+        build_index(args.train, args.index, k1=args.k1, b=args.b, max_df=args.max_df)
+        return
+
+    index = BM25Index(args.index)
+    if args.subtask == 'B':
+        rows = read_data(args.data, 5)
+        predictions = predict_taskB(index, rows, args.top_k, args.depth)
+        output = args.output or 'subtaskB_answers.csv'
+    else:
+        rows = read_data(args.data, 2)
+        predictions = predict_taskC(index, rows, args.top_k, args.depth)
+        output = args.output or 'subtaskC_answers.csv'
+    write_predictions(output, predictions)
+    index.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='BM25 retrieval baseline for SemEval 2020 Task 4 subtasks B and C')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='index the reasons of train.csv')
+    build_parser.add_argument('--train', '-t', default='ALL data/train.csv',
+                              help='combined training csv')
+    build_parser.add_argument('--index', '-i', required=True, help='index file to write')
+    build_parser.add_argument('--k1', type=float, default=1.2, help='BM25 k1')
+    build_parser.add_argument('--b', type=float, default=0.75, help='BM25 b')
+    build_parser.add_argument('--max-df', type=float, default=0.1,
+                              help='drop terms occurring in more than this fraction of reasons')
+
+    predict_parser = subparsers.add_parser('predict', help='answer a subtask B or C data file')
+    predict_parser.add_argument('--index', '-i', required=True, help='index file to read')
+    predict_parser.add_argument('--subtask', '-s', choices=['B', 'C'], required=True)
+    predict_parser.add_argument('--data', '-d', required=True, help='subtask data file in csv format')
+    predict_parser.add_argument('--output', '-o',
+                                help='submission file (default: subtask{B,C}_answers.csv)')
+    predict_parser.add_argument('--top-k', '-k', type=int, default=10,
+                                help='number of reasons retrieved per query')
+    predict_parser.add_argument('--depth', type=int, default=1000,
+                                help='maximum number of postings visited per query term')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    main()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Training data loader for the three subtasks.
+#
+# Instances are streamed from the subtask data/answer files, tokenized once and
+# cached on disk (keyed by the file contents and the tokenizer), then served as
+# length-bucketed, padded batches. Batch order is a pure function of
+# (seed, epoch), so an iterator can be resumed from its `state_dict()`.
+# With num_workers > 0, batches are collated on worker processes and up to
+# `prefetch` batches per worker are kept in flight.
+
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+import argparse
+import collections
+import csv
+import hashlib
+import logging
+import multiprocessing
+import os
+import pickle
+import random
+import re
+import sys
+import time
+
+
+EXIT_STATUS_DATA_MALFORMED = 1
+
+# subtask -> number of text fields after the id
+SUBTASK_FIELDS = {'A': 2, 'B': 4, 'C': 1}
+
+PAD_ID, UNK_ID = 0, 1
+
+Instance = collections.namedtuple('Instance', ['id', 'texts', 'label'])
+
+WORD_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def _parse_label(subtask: str, row: List[str]):
+    if subtask == 'A':
+        return int(row[1])
+    if subtask == 'B':
+        return 'ABC'.index(row[1])
+    return [ref for ref in row[1:] if ref]
+
+
+def read_instances(subtask: str, data_file: str,
+                   answers_file: Optional[str] = None) -> Iterator[Instance]:
+    """Streams the instances of a subtask data file, joined with their answers.
+    Without an answers file, every label is None."""
+    answers = {}
+    if answers_file is not None:
+        with open(answers_file, "rt", encoding="UTF-8", errors="replace") as f:
+            reader = csv.reader(f)
+            try:
+                for row in reader:
+                    try:
+                        answers[row[0]] = _parse_label(subtask, row)
+                    except (IndexError, ValueError) as e:
+                        logging.error("Error reading value from CSV file %s on line %d: %s",
+                                      answers_file, reader.line_num, e)
+                        sys.exit(EXIT_STATUS_DATA_MALFORMED)
+            except csv.Error as e:
+                logging.error('file %s, line %d: %s', answers_file, reader.line_num, e)
+                sys.exit(EXIT_STATUS_DATA_MALFORMED)
+
+    width = SUBTASK_FIELDS[subtask] + 1
+    with open(data_file, "rt", encoding="UTF-8", errors="replace") as f:
+        reader = csv.reader(f)
+        try:
+            next(reader, None)
+            for row in reader:
+                if len(row) < width:
+                    logging.error("Expected %d fields in %s on line %d, found %d",
+                                  width, data_file, reader.line_num, len(row))
+                    sys.exit(EXIT_STATUS_DATA_MALFORMED)
+                if answers_file is not None and row[0] not in answers:
+                    logging.error("Missing answer for instance '%s' in %s", row[0], answers_file)
+                    sys.exit(EXIT_STATUS_DATA_MALFORMED)
+                yield Instance(row[0], row[1:width], answers.get(row[0]))
+        except csv.Error as e:
+            logging.error('file %s, line %d: %s', data_file, reader.line_num, e)
+            sys.exit(EXIT_STATUS_DATA_MALFORMED)
+
+
+class WordTokenizer(object):
+    """Lower-cased word/punctuation tokenizer mapping tokens to vocabulary ids.
+    Id 0 is padding and id 1 is unknown."""
+
+    def __init__(self, vocab: List[str]):
+        self.vocab = vocab
+        self.word_ids = {w: i for i, w in enumerate(vocab)}
+        digest = hashlib.sha1('\n'.join(vocab).encode('utf-8')).hexdigest()[:12]
+        self.name = f'word-{digest}'
+
+    @classmethod
+    def build(cls, instances: Iterable[Instance], min_count: int = 1) -> 'WordTokenizer':
+        counts = collections.Counter()
+        for instance in instances:
+            for text in instance.texts:
+                counts.update(WORD_RE.findall(text.lower()))
+        return cls(['<pad>', '<unk>'] + sorted(w for w, c in counts.items() if c >= min_count))
+
+    def __call__(self, text: str) -> List[int]:
+        get = self.word_ids.get
+        return [get(w, UNK_ID) for w in WORD_RE.findall(text.lower())]
+
+
+def _tokenize_chunk(tokenizer: Callable[[str], List[int]], chunk: List[Instance]) -> List[Instance]:
+    return [Instance(i.id, [tokenizer(t) for t in i.texts], i.label) for i in chunk]
+
+
+def _chunks(iterable: Iterable, size: int) -> Iterator[List]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def tokenize_dataset(subtask: str, data_file: str, answers_file: Optional[str],
+                     tokenizer: WordTokenizer, cache_dir: Optional[str] = None,
+                     num_workers: int = 0) -> List[Instance]:
+    """Returns the tokenized instances of a data file. The result is cached in
+    `cache_dir` under a key derived from the file contents and tokenizer name,
+    so a file is only tokenized once however many epochs or runs read it."""
+    cache_file = None
+    if cache_dir is not None:
+        key = hashlib.sha1(f'{subtask}\0{tokenizer.name}'.encode('utf-8'))
+        for filename in (data_file, answers_file):
+            if filename is not None:
+                with open(filename, 'rb') as f:
+                    key.update(f.read())
+        cache_file = os.path.join(cache_dir, f'tokenized-{key.hexdigest()}.pkl')
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                return [Instance(*fields) for fields in pickle.load(f)]
+
+    instances = read_instances(subtask, data_file, answers_file)
+    if num_workers > 0:
+        with multiprocessing.Pool(num_workers) as pool:
+            chunks = pool.starmap(_tokenize_chunk,
+                                  ((tokenizer, chunk) for chunk in _chunks(instances, 1000)))
+        dataset = [instance for chunk in chunks for instance in chunk]
+    else:
+        dataset = _tokenize_chunk(tokenizer, list(instances))
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_file + '.tmp', 'wb') as f:
+            # plain tuples, so the cache does not depend on the module Instance was defined in
+            pickle.dump([tuple(instance) for instance in dataset], f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_file + '.tmp', cache_file)
+    return dataset
+
+
+def collate(dataset: List[Instance], indices: List[int], pad_id: int = PAD_ID) -> Dict[str, list]:
+    """Pads every text field of the selected instances to the longest one in the batch.
+    Returns {'ids', 'inputs': [field][instance][token], 'lengths': [field][instance], 'labels'}."""
+    instances = [dataset[i] for i in indices]
+    num_fields = len(instances[0].texts)
+    inputs = []
+    lengths = []
+    for field in range(num_fields):
+        sequences = [instance.texts[field] for instance in instances]
+        width = max(len(s) for s in sequences)
+        inputs.append([s + [pad_id] * (width - len(s)) for s in sequences])
+        lengths.append([len(s) for s in sequences])
+    return {
+        'ids': [instance.id for instance in instances],
+        'inputs': inputs,
+        'lengths': lengths,
+        'labels': [instance.label for instance in instances],
+    }
+
+
+_worker_dataset = None
+_worker_pad_id = PAD_ID
+
+
+def _init_worker(dataset: List[Instance], pad_id: int):
+    global _worker_dataset, _worker_pad_id
+    _worker_dataset = dataset
+    _worker_pad_id = pad_id
+
+
+def _collate_in_worker(indices: List[int]) -> Dict[str, list]:
+    return collate(_worker_dataset, indices, _worker_pad_id)
+
+
+class BucketIterator(object):
+    """Deterministic, resumable iterator over length-bucketed batches.
+
+    Every epoch, instance indices are shuffled with Random(seed + epoch), cut into
+    pools of `pool_size` batches, sorted by length within each pool and split
+    into batches, and the batches are shuffled again. Instances of similar length
+    end up together, which keeps padding low without fixing the batch order."""
+
+    def __init__(self, dataset: List[Instance], batch_size: int, seed: int = 0,
+                 shuffle: bool = True, pool_size: int = 100, num_workers: int = 0,
+                 prefetch: int = 2, pad_id: int = PAD_ID):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.seed = seed
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.pad_id = pad_id
+        self.epoch = 0
+        self.batches_yielded = 0
+        self._lengths = [max(len(t) for t in instance.texts) for instance in dataset]
+        self._pool = None
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def plan(self, epoch: int) -> List[List[int]]:
+        """Returns the batches of `epoch` as lists of dataset indices."""
+        indices = list(range(len(self.dataset)))
+        if not self.shuffle:
+            return [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+
+        rng = random.Random(self.seed + epoch)
+        rng.shuffle(indices)
+        pool = self.batch_size * self.pool_size
+        batches = []
+        for start in range(0, len(indices), pool):
+            chunk = sorted(indices[start:start + pool], key=self._lengths.__getitem__)
+            batches.extend(chunk[i:i + self.batch_size] for i in range(0, len(chunk), self.batch_size))
+        rng.shuffle(batches)
+        return batches
+
+    def state_dict(self) -> Dict[str, int]:
+        return {'seed': self.seed, 'epoch': self.epoch, 'batches_yielded': self.batches_yielded}
+
+    def load_state_dict(self, state: Dict[str, int]):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.batches_yielded = state['batches_yielded']
+
+    def __iter__(self) -> Iterator[Dict[str, list]]:
+        """Yields the remaining batches of the current epoch, then moves to the next epoch."""
+        plan = self.plan(self.epoch)[self.batches_yielded:]
+        if self.num_workers > 0:
+            batches = self._prefetched(plan)
+        else:
+            batches = (collate(self.dataset, indices, self.pad_id) for indices in plan)
+
+        for batch in batches:
+            self.batches_yielded += 1
+            yield batch
+
+        self.epoch += 1
+        self.batches_yielded = 0
+
+    def _prefetched(self, plan: List[List[int]]) -> Iterator[Dict[str, list]]:
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.num_workers, initializer=_init_worker,
+                                              initargs=(self.dataset, self.pad_id))
+        pending = collections.deque()
+        plan = iter(plan)
+        for indices in plan:
+            pending.append(self._pool.apply_async(_collate_in_worker, (indices,)))
+            if len(pending) >= self.num_workers * self.prefetch:
+                break
+        while pending:
+            batch = pending.popleft().get()
+            for indices in plan:
+                pending.append(self._pool.apply_async(_collate_in_worker, (indices,)))
+                break
+            yield batch
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def main():
+    tokenizer = WordTokenizer.build(read_instances(args.subtask, args.data, args.answers),
+                                    min_count=args.min_count)
+    start = time.perf_counter()
+    dataset = tokenize_dataset(args.subtask, args.data, args.answers, tokenizer,
+                               cache_dir=args.cache_dir, num_workers=args.num_workers)
+    logging.info("Loaded %d instances in %.3fs", len(dataset), time.perf_counter() - start)
+
+    iterator = BucketIterator(dataset, args.batch_size, seed=args.seed,
+                              num_workers=args.num_workers, prefetch=args.prefetch)
+    for epoch in range(args.epochs):
+        start = time.perf_counter()
+        tokens = padded = 0
+        for batch in iterator:
+            for field_inputs, field_lengths in zip(batch['inputs'], batch['lengths']):
+                tokens += sum(field_lengths)
+                padded += sum(len(row) for row in field_inputs)
+        logging.info("Epoch %d: %d batches in %.3fs, %.1f%% padding", epoch, len(iterator),
+                     time.perf_counter() - start, 100 * (padded - tokens) / max(padded, 1))
+    iterator.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Iterate over SemEval 2020 Task 4 training batches and report loader statistics')
+    parser.add_argument('--subtask', '-s', choices=sorted(SUBTASK_FIELDS), required=True)
+    parser.add_argument('--data', '-d', required=True, help='subtask data file in csv format')
+    parser.add_argument('--answers', '-a', help='subtask answers file in csv format')
+    parser.add_argument('--cache-dir', help='directory for cached tokenized datasets')
+    parser.add_argument('--batch-size', '-b', type=int, default=32)
+    parser.add_argument('--epochs', '-e', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--min-count', type=int, default=1,
+                        help='map words seen fewer times to <unk>')
+    parser.add_argument('--num-workers', '-j', type=int, default=0,
+                        help='worker processes for tokenization and batch collation')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='batches kept in flight per worker')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    main()
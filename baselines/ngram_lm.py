@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Count-based n-gram language model baseline for subtask A.
+#
+# `train` collects interpolated Kneser-Ney statistics from the statements of
+# train.csv and writes them to a single model file. N-grams are packed into
+# 64-bit integer keys (21 bits per token id), and every table is a sorted key
+# array with parallel count arrays, looked up by binary search.
+# `predict` memory-maps the model, scores sent0 and sent1 of every instance and
+# answers with the sentence the model finds less likely, i.e. the nonsensical one.
+
+from typing import Dict, List, Sequence, Tuple
+from bisect import bisect_left
+import argparse
+import array
+import collections
+import csv
+import logging
+import math
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from section_file import read_sections, write_sections  # noqa: E402
+
+
+EXIT_STATUS_DATA_MALFORMED = 1
+EXIT_STATUS_MODEL_MALFORMED = 2
+
+COMBINED_HEADER = ['Correct Statement', 'Incorrect Statement', 'Right Reason1',
+                   'Confusing Reason1', 'Confusing Reason2', 'Right Reason2', 'Right Reason3']
+
+MODEL_MAGIC = b'KNLM0001\n'
+
+UNK, BOS, EOS = 0, 1, 2
+SPECIAL_TOKENS = ['<unk>', '<s>', '</s>']
+
+ID_BITS = 21
+MAX_ORDER = 64 // ID_BITS
+
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+def pack(ids: Sequence[int]) -> int:
+    key = 0
+    for i in ids:
+        key = (key << ID_BITS) | i
+    return key
+
+
+def _discount(counts: Dict[Tuple[int, ...], int]) -> float:
+    """Ney et al. absolute discount D = n1 / (n1 + 2 * n2)."""
+    count_of_counts = collections.Counter(c for c in counts.values() if c <= 2)
+    n1, n2 = count_of_counts[1], count_of_counts[2]
+    if n1 == 0:
+        return 0.5
+    return n1 / (n1 + 2 * n2)
+
+
+def read_statements(train_file: str) -> List[str]:
+    """Returns the Correct Statement column of a combined csv."""
+    statements = []
+    with open(train_file, "rt", encoding="UTF-8", errors="replace") as f:
+        reader = csv.reader(f)
+        try:
+            header = next(reader, None)
+            if header != COMBINED_HEADER:
+                logging.error("Unexpected header %s in %s", header, train_file)
+                sys.exit(EXIT_STATUS_DATA_MALFORMED)
+            for row in reader:
+                if len(row) != len(COMBINED_HEADER):
+                    logging.error("Expected %d fields in %s on line %d, found %d",
+                                  len(COMBINED_HEADER), train_file, reader.line_num, len(row))
+                    sys.exit(EXIT_STATUS_DATA_MALFORMED)
+                statements.append(row[0])
+        except csv.Error as e:
+            logging.error('file %s, line %d: %s', train_file, reader.line_num, e)
+            sys.exit(EXIT_STATUS_DATA_MALFORMED)
+    return statements
+
+
+def train(sentences: List[str], model_file: str, order: int = 3, min_count: int = 1):
+    """Collects Kneser-Ney statistics up to `order` and writes them to `model_file`.
+
+    For the highest order the tables hold raw counts; for lower orders they hold
+    continuation counts N1+(. g), except for n-grams starting with <s>, which
+    have no left context and keep their raw counts."""
+    if not 1 <= order <= MAX_ORDER:
+        logging.error("Order must be between 1 and %d", MAX_ORDER)
+        sys.exit(EXIT_STATUS_DATA_MALFORMED)
+
+    tokenized = [tokenize(s) for s in sentences]
+    word_counts = collections.Counter(t for tokens in tokenized for t in tokens)
+    vocab = SPECIAL_TOKENS + sorted(w for w, c in word_counts.items() if c >= min_count)
+    if len(vocab) >= 1 << ID_BITS:
+        logging.error("Vocabulary of %d words does not fit in %d bits", len(vocab), ID_BITS)
+        sys.exit(EXIT_STATUS_DATA_MALFORMED)
+    word_ids = {w: i for i, w in enumerate(vocab)}
+
+    counts = [None] + [collections.Counter() for _ in range(order)]
+    for tokens in tokenized:
+        ids = [BOS] * (order - 1) + [word_ids.get(t, UNK) for t in tokens] + [EOS]
+        for i in range(order - 1, len(ids)):
+            counts[order][tuple(ids[i - order + 1:i + 1])] += 1
+
+    for k in range(order - 1, 0, -1):
+        # distinct left extensions among the (k+1)-grams seen in training
+        continuations = collections.Counter(gram[1:] for gram in counts[k + 1])
+        for gram, c in counts[order].items():
+            suffix = gram[-k:]
+            if suffix[0] == BOS:
+                counts[k][suffix] += c
+        for suffix, c in continuations.items():
+            if suffix[0] != BOS:
+                counts[k][suffix] = c
+
+    sections = []
+    discounts = [0.0]
+    for k in range(1, order + 1):
+        discounts.append(_discount(counts[k]))
+        keys = sorted((pack(gram), c) for gram, c in counts[k].items())
+        sections.append((f'ngrams{k}.keys', array.array('Q', (key for key, _ in keys))))
+        sections.append((f'ngrams{k}.counts', array.array('I', (c for _, c in keys))))
+
+        contexts = collections.defaultdict(lambda: [0, 0])
+        for gram, c in counts[k].items():
+            context = contexts[pack(gram[:-1])]
+            context[0] += c
+            context[1] += 1
+        keys = sorted(contexts.items())
+        sections.append((f'contexts{k}.keys', array.array('Q', (key for key, _ in keys))))
+        sections.append((f'contexts{k}.totals', array.array('I', (v[0] for _, v in keys))))
+        sections.append((f'contexts{k}.types', array.array('I', (v[1] for _, v in keys))))
+    sections.append(('vocab', '\n'.join(vocab).encode('utf-8')))
+
+    write_sections(model_file, MODEL_MAGIC, {'order': order, 'discounts': discounts}, sections)
+    logging.info("Trained order %d model on %d sentences, %d words in vocabulary",
+                 order, len(sentences), len(vocab))
+
+
+class KneserNeyModel(object):
+    """Read-only view of a model file written by `train`."""
+
+    def __init__(self, model_file: str):
+        try:
+            self._mapped = read_sections(model_file, MODEL_MAGIC)
+        except ValueError:
+            logging.error("%s is not an n-gram model", model_file)
+            sys.exit(EXIT_STATUS_MODEL_MALFORMED)
+        self.order = self._mapped.header['order']
+        self.discounts = self._mapped.header['discounts']
+        sections = self._mapped.sections
+
+        self.ngrams = [None] + [(sections[f'ngrams{k}.keys'], sections[f'ngrams{k}.counts'])
+                                for k in range(1, self.order + 1)]
+        self.contexts = [None] + [(sections[f'contexts{k}.keys'], sections[f'contexts{k}.totals'],
+                                   sections[f'contexts{k}.types'])
+                                  for k in range(1, self.order + 1)]
+        self.word_ids = {w: i for i, w in
+                         enumerate(bytes(sections['vocab']).decode('utf-8').split('\n'))}
+        self.vocab_size = len(self.word_ids)
+
+    @staticmethod
+    def _find(keys, key: int) -> int:
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return i
+        return -1
+
+    def _prob(self, gram: Tuple[int, ...], cache: Dict[Tuple[int, ...], float]) -> float:
+        """Interpolated Kneser-Ney probability of gram[-1] given gram[:-1]."""
+        p = cache.get(gram)
+        if p is not None:
+            return p
+
+        k = len(gram)
+        lower = self._prob(gram[1:], cache) if k > 1 else 1.0 / self.vocab_size
+        context_keys, totals, types = self.contexts[k]
+        i = self._find(context_keys, pack(gram[:-1]))
+        if i < 0:
+            p = lower
+        else:
+            keys, counts = self.ngrams[k]
+            j = self._find(keys, pack(gram))
+            count = counts[j] if j >= 0 else 0
+            discount = self.discounts[k]
+            p = (max(count - discount, 0) + discount * types[i] * lower) / totals[i]
+
+        cache[gram] = p
+        return p
+
+    def score_batch(self, sentences: List[str]) -> List[float]:
+        """Returns the average log probability per token (including </s>) of
+        every sentence. Probabilities are memoized across the batch."""
+        cache = {}
+        scores = []
+        for sentence in sentences:
+            ids = [BOS] * (self.order - 1) + \
+                [self.word_ids.get(t, UNK) for t in tokenize(sentence)] + [EOS]
+            log_prob = 0.0
+            for i in range(self.order - 1, len(ids)):
+                log_prob += math.log(self._prob(tuple(ids[i - self.order + 1:i + 1]), cache))
+            scores.append(log_prob / (len(ids) - self.order + 1))
+        return scores
+
+    def close(self):
+        self._mapped.close()
+
+
+def read_data_taskA(filename: str) -> List[List[str]]:
+    rows = []
+    with open(filename, "rt", encoding="UTF-8", errors="replace") as f:
+        reader = csv.reader(f)
+        try:
+            next(reader, None)
+            for row in reader:
+                if len(row) < 3:
+                    logging.error("Expected 3 fields in %s on line %d, found %d",
+                                  filename, reader.line_num, len(row))
+                    sys.exit(EXIT_STATUS_DATA_MALFORMED)
+                rows.append(row)
+        except csv.Error as e:
+            logging.error('file %s, line %d: %s', filename, reader.line_num, e)
+            sys.exit(EXIT_STATUS_DATA_MALFORMED)
+    return rows
+
+
+def predict_taskA(model: KneserNeyModel, rows: List[List[str]]) -> Dict[str, str]:
+    scores = model.score_batch([sent for row in rows for sent in row[1:3]])
+    predictions = {}
+    for i, row in enumerate(rows):
+        # the nonsensical sentence is the less likely one
+        predictions[row[0]] = '0' if scores[2 * i] < scores[2 * i + 1] else '1'
+    return predictions
+
+
+def write_predictions(filename: str, predictions: Dict[str, str]):
+    with open(filename, "wt", encoding="UTF-8", newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        for instance_id, prediction in predictions.items():
+            writer.writerow([instance_id, prediction])
+
+
+def main():
+    if args.command == 'train':
+        train(read_statements(args.train), args.model, order=args.order, min_count=args.min_count)
+        return
+
+    model = KneserNeyModel(args.model)
+    predictions = predict_taskA(model, read_data_taskA(args.data))
+    write_predictions(args.output, predictions)
+    model.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='n-gram language model baseline for SemEval 2020 Task 4 subtask A')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    train_parser = subparsers.add_parser('train', help='train on the statements of train.csv')
+    train_parser.add_argument('--train', '-t', default='ALL data/train.csv',
+                              help='combined training csv')
+    train_parser.add_argument('--model', '-m', required=True, help='model file to write')
+    train_parser.add_argument('--order', '-n', type=int, default=3, help='n-gram order')
+    train_parser.add_argument('--min-count', type=int, default=1,
+                              help='map words seen fewer times to <unk>')
+
+    predict_parser = subparsers.add_parser('predict', help='answer a subtask A data file')
+    predict_parser.add_argument('--model', '-m', required=True, help='model file to read')
+    predict_parser.add_argument('--data', '-d', required=True,
+                                help='subtask A data file in csv format')
+    predict_parser.add_argument('--output', '-o', default='subtaskA_answers.csv',
+                                help='submission file')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Binary file format shared by the baseline models and indexes.
+#
+# A file is a magic line, a JSON header line and a sequence of named sections,
+# each an array.array or a bytes blob. Every section starts on an 8 byte
+# boundary, so a reader can memory-map the file and cast each section in place
+# instead of copying it into memory.
+
+from typing import Dict, List, Tuple, Union
+import array
+import json
+import mmap
+import os
+
+
+Section = Union[array.array, bytes]
+
+
+def write_sections(filename: str, magic: bytes, header: Dict[str, object],
+                   sections: List[Tuple[str, Section]]):
+    """Writes `header` and `sections` to `filename`, replacing it atomically.
+    The name, typecode and length of every section are added to the header."""
+    header = dict(header, sections=[])
+    for name, data in sections:
+        typecode = data.typecode if isinstance(data, array.array) else 'B'
+        header['sections'].append([name, typecode, len(data)])
+
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(magic)
+        f.write(json.dumps(header).encode('utf-8') + b'\n')
+        for _, data in sections:
+            # keep every section aligned so it can be cast in place after mmap
+            f.write(b'\0' * (-f.tell() % 8))
+            f.write(data.tobytes() if isinstance(data, array.array) else data)
+    os.replace(filename + '.tmp', filename)
+
+
+class MappedSections(object):
+    """Header and sections of a file written by `write_sections`. The sections
+    are memoryviews into a read-only mmap of the file and stay valid until
+    `close` is called."""
+
+    def __init__(self, header: Dict[str, object], sections: Dict[str, memoryview],
+                 views: List[memoryview], mapping: mmap.mmap, file):
+        self.header = header
+        self.sections = sections
+        self._views = views
+        self._mmap = mapping
+        self._file = file
+
+    def close(self):
+        # the mmap cannot be closed while views into it are alive
+        for view in self._views:
+            view.release()
+        self._mmap.close()
+        self._file.close()
+
+
+def read_sections(filename: str, magic: bytes) -> MappedSections:
+    """Memory-maps a file written by `write_sections`. Raises ValueError if the
+    file does not start with `magic`."""
+    f = open(filename, 'rb')
+    mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapping[:len(magic)] != magic:
+        mapping.close()
+        f.close()
+        raise ValueError(f"{filename} does not start with {magic!r}")
+    end = mapping.find(b'\n', len(magic))
+    header = json.loads(mapping[len(magic):end])
+
+    buffer = memoryview(mapping)
+    position = end + 1
+    sections = {}
+    for name, typecode, length in header['sections']:
+        position += -position % 8
+        size = length * array.array(typecode).itemsize
+        sections[name] = buffer[position:position + size].cast(typecode)
+        position += size
+    return MappedSections(header, sections, [buffer] + list(sections.values()), mapping, f)
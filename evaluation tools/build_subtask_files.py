@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Builds the per-subtask data and gold answer files from the combined csv files.
+#
+# Every combined record (Correct Statement, Incorrect Statement, Right Reason1,
+# Confusing Reason1, Confusing Reason2, Right Reason2, Right Reason3) becomes
+# one instance of each subtask:
+#   A: both statements in shuffled order, the answer is the index of the
+#      nonsensical one;
+#   B: the incorrect statement with Right Reason1 and the two confusing
+#      reasons in shuffled order, the answer is the letter of the right reason;
+#   C: the incorrect statement, the references are the three right reasons.
+#
+# A split is streamed once, writing its six files side by side. The shuffles
+# come from one random generator per split seeded with the seed and the split
+# name, so the output only depends on the input file, the seed and --copies.
+# Splits are built in parallel.
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import csv
+import itertools
+import logging
+import os
+import random
+import sys
+
+
+EXIT_STATUS_DATA_MALFORMED = 1
+
+COMBINED_HEADER = ['Correct Statement', 'Incorrect Statement', 'Right Reason1',
+                   'Confusing Reason1', 'Confusing Reason2', 'Right Reason2', 'Right Reason3']
+
+# split -> (directory, combined file, subtask -> (data file, gold file))
+SPLITS = {
+    'train': ('Training  Data', 'train.csv', {
+        'A': ('subtaskA_data_all.csv', 'subtaskA_answers_all.csv'),
+        'B': ('subtaskB_data_all.csv', 'subtaskB_answers_all.csv'),
+        'C': ('subtaskC_data_all.csv', 'subtaskC_answers_all.csv'),
+    }),
+    'dev': ('Dev Data', 'dev.csv', {
+        'A': ('subtaskA_dev_data.csv', 'subtaskA_gold_answers.csv'),
+        'B': ('subtaskB_dev_data.csv', 'subtaskB_gold_answers.csv'),
+        'C': ('subtaskC_dev_data.csv', 'subtaskC_gold_answers.csv'),
+    }),
+    'test': ('Test Data', 'test.csv', {
+        'A': ('subtaskA_test_data.csv', 'subtaskA_gold_answers.csv'),
+        'B': ('subtaskB_test_data.csv', 'subtaskB_gold_answers.csv'),
+        'C': ('subtaskC_test_data.csv', 'subtaskC_gold_answers.csv'),
+    }),
+}
+
+DATA_HEADERS = {
+    'A': ['id', 'sent0', 'sent1'],
+    'B': ['id', 'FalseSent', 'OptionA', 'OptionB', 'OptionC'],
+    'C': ['id', 'FalseSent'],
+}
+
+# orders of (Right Reason1, Confusing Reason1, Confusing Reason2) in subtask B,
+# with the letter the right reason ends up at
+OPTION_ORDERS = [(order, 'ABC'[order.index(0)]) for order in itertools.permutations(range(3))]
+
+
+def quote(field: str) -> str:
+    """Quotes a field the way csv.writer does with the default dialect."""
+    if any(c in field for c in ',"\r\n'):
+        return '"' + field.replace('"', '""') + '"'
+    return field
+
+
+def build_split(split: str, data_dir: str, output_dir: str, seed: int, copies: int) -> int:
+    """Writes the six subtask files of `split` and returns the number of instances.
+    Every combined record yields `copies` instances with independent shuffles;
+    record r gets the ids r * copies to r * copies + copies - 1."""
+    directory, combined_name, layout = SPLITS[split]
+    combined_file = os.path.join(data_dir, combined_name)
+    split_dir = os.path.join(output_dir, directory)
+    os.makedirs(split_dir, exist_ok=True)
+
+    rng = random.Random(f'{seed}-{split}')
+    coin = rng.getrandbits
+    pick = rng.randrange
+
+    files = {}
+    for subtask, names in layout.items():
+        for kind, name in zip(('data', 'gold'), names):
+            files[subtask, kind] = open(os.path.join(split_dir, name + '.tmp'), "wt",
+                                        encoding="UTF-8", newline='', buffering=1 << 20)
+        files[subtask, 'data'].write(','.join(DATA_HEADERS[subtask]) + '\n')
+    write_a, gold_a = files['A', 'data'].write, files['A', 'gold'].write
+    write_b, gold_b = files['B', 'data'].write, files['B', 'gold'].write
+    write_c, gold_c = files['C', 'data'].write, files['C', 'gold'].write
+
+    instances = 0
+    with open(combined_file, "rt", encoding="UTF-8", errors="replace") as f:
+        reader = csv.reader(f)
+        try:
+            header = next(reader, None)
+            if header != COMBINED_HEADER:
+                logging.error("Unexpected header %s in %s", header, combined_file)
+                sys.exit(EXIT_STATUS_DATA_MALFORMED)
+            for row in reader:
+                if len(row) != len(COMBINED_HEADER):
+                    logging.error("Expected %d fields in %s on line %d, found %d",
+                                  len(COMBINED_HEADER), combined_file, reader.line_num, len(row))
+                    sys.exit(EXIT_STATUS_DATA_MALFORMED)
+                # fields are quoted once per record, the copies only differ in id and order
+                correct, incorrect, right1, confusing1, confusing2, right2, right3 = map(quote, row)
+                reasons = (right1, confusing1, confusing2)
+                statements_a = (f',{incorrect},{correct}\n', f',{correct},{incorrect}\n')
+                data_c = f',{incorrect}\n'
+                gold_c_line = f',{right1},{right2},{right3}\n'
+                for _ in range(copies):
+                    instance_id = str(instances)
+                    label = coin(1) ^ 1
+                    write_a(instance_id + statements_a[label])
+                    gold_a(f'{instance_id},{label}\n')
+                    order, answer = OPTION_ORDERS[pick(6)]
+                    write_b(f'{instance_id},{incorrect},{reasons[order[0]]},{reasons[order[1]]},'
+                            f'{reasons[order[2]]}\n')
+                    gold_b(f'{instance_id},{answer}\n')
+                    write_c(instance_id + data_c)
+                    gold_c(instance_id + gold_c_line)
+                    instances += 1
+        except csv.Error as e:
+            logging.error('file %s, line %d: %s', combined_file, reader.line_num, e)
+            sys.exit(EXIT_STATUS_DATA_MALFORMED)
+
+    for f in files.values():
+        f.close()
+        os.replace(f.name, f.name[:-len('.tmp')])
+    return instances
+
+
+def main():
+    if args.copies < 1:
+        logging.error("--copies must be at least 1")
+        sys.exit(EXIT_STATUS_DATA_MALFORMED)
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {split: executor.submit(build_split, split, args.data_dir, args.output_dir,
+                                          args.seed, args.copies)
+                   for split in args.splits}
+
+    status = 0
+    for split, future in futures.items():
+        try:
+            logging.info("%s: wrote %d instances to %s", split, future.result(),
+                         os.path.join(args.output_dir, SPLITS[split][0]))
+        except SystemExit as e:
+            status = status or e.code
+    if status:
+        sys.exit(status)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the SemEval 2020 Task 4 subtask files from the combined csv files')
+    parser.add_argument('--data-dir', '-d', default='ALL data',
+                        help='directory holding train.csv, dev.csv and test.csv')
+    parser.add_argument('--output-dir', '-o', required=True,
+                        help='directory the per-split subtask directories are written to')
+    parser.add_argument('--splits', nargs='+', choices=list(SPLITS), default=list(SPLITS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--copies', type=int, default=1,
+                        help='instances built from every combined record, each shuffled anew')
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    main()
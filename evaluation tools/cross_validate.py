@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# k-fold cross-validation harness over the training data.
+#
+# `split` assigns every training instance to one of k folds once, with a seeded
+# shuffle, and writes the assignment to a csv file. `score` scores the
+# per-fold prediction files of subtasks A, B and C against the matching slice
+# of the training gold files, all (fold, subtask) pairs at the same time on a
+# process pool, using the metric functions of the official scorers.
+
+from typing import Dict, List
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import csv
+import logging
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import taskA_scorer  # noqa: E402
+import taskB_scorer  # noqa: E402
+import taskC_scorer  # noqa: E402
+
+
+EXIT_STATUS_FOLDS_MALFORMED = 1
+EXIT_STATUS_PREDICTION_FILE_MISSING = 5
+
+TRAINING_DIR = 'ALL data/Training  Data'
+
+# subtask -> (gold file, metric name)
+SUBTASKS = {
+    'A': ('subtaskA_answers_all.csv', 'Accuracy'),
+    'B': ('subtaskB_answers_all.csv', 'Accuracy'),
+    'C': ('subtaskC_answers_all.csv', 'BLEU'),
+}
+
+
+def build_folds(ids: List[str], k: int, seed: int) -> Dict[str, int]:
+    """Assigns ids to k folds of (almost) equal size. The result only depends on
+    the set of ids, k and the seed."""
+    ordered = sorted(ids, key=lambda i: (len(i), i))
+    random.Random(seed).shuffle(ordered)
+    return {instance_id: position % k for position, instance_id in enumerate(ordered)}
+
+
+def read_training_ids(train_file: str, gold_file: str) -> List[str]:
+    """Returns the ids of the training gold file, after checking that the
+    combined train.csv has one record per id."""
+    ids = list(taskA_scorer.read_gold(gold_file).keys())
+    with open(train_file, "rt", encoding="UTF-8", errors="replace") as f:
+        records = sum(1 for _ in csv.reader(f)) - 1
+    if records != len(ids):
+        logging.error("%s has %d records but %s has %d answers", train_file, records, gold_file, len(ids))
+        sys.exit(EXIT_STATUS_FOLDS_MALFORMED)
+    return ids
+
+
+def write_folds(filename: str, folds: Dict[str, int]):
+    with open(filename, "wt", encoding="UTF-8", newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['id', 'fold'])
+        for instance_id, fold in folds.items():
+            writer.writerow([instance_id, fold])
+
+
+def read_folds(filename: str) -> Dict[str, int]:
+    folds = {}
+    with open(filename, "rt", encoding="UTF-8", errors="replace") as f:
+        reader = csv.reader(f)
+        try:
+            next(reader, None)
+            for row in reader:
+                try:
+                    folds[row[0]] = int(row[1])
+                except (IndexError, ValueError) as e:
+                    logging.error("Error reading value from CSV file %s on line %d: %s",
+                                  filename, reader.line_num, e)
+                    sys.exit(EXIT_STATUS_FOLDS_MALFORMED)
+        except csv.Error as e:
+            logging.error('file %s, line %d: %s', filename, reader.line_num, e)
+            sys.exit(EXIT_STATUS_FOLDS_MALFORMED)
+    return folds
+
+
+def score_fold(subtask: str, gold: Dict[str, object], prediction_file: str) -> float:
+    """Scores one fold's prediction file against the gold entries of that fold."""
+    if subtask == 'C':
+        predictions = taskC_scorer.read_predictions(prediction_file)
+        return taskC_scorer.calculate_bleu(gold, predictions)
+
+    scorer = taskA_scorer if subtask == 'A' else taskB_scorer
+    if scorer.is_scored_predictions(prediction_file, scorer.LABELS):
+        predictions = scorer.read_scored_predictions(prediction_file, scorer.LABELS)
+        return scorer.calculate_ranking_metrics(gold, predictions, scorer.LABELS)['Accuracy']
+    predictions = scorer.read_predictions(prediction_file)
+    return scorer.calculate_accuracy(gold, predictions)
+
+
+def main_split():
+    if os.path.exists(args.folds) and not args.force:
+        logging.error("%s already exists, pass --force to rebuild it", args.folds)
+        sys.exit(EXIT_STATUS_FOLDS_MALFORMED)
+    ids = read_training_ids(args.train, os.path.join(args.training_dir, SUBTASKS['A'][0]))
+    write_folds(args.folds, build_folds(ids, args.k, args.seed))
+    logging.info("Wrote %d folds over %d instances to %s", args.k, len(ids), args.folds)
+
+
+def main_score():
+    folds = read_folds(args.folds)
+    k = max(folds.values()) + 1
+
+    jobs = []
+    for subtask in args.subtasks:
+        gold_name, _ = SUBTASKS[subtask]
+        gold_file = os.path.join(args.training_dir, gold_name)
+        if subtask == 'C':
+            gold = taskC_scorer.read_references(gold_file)
+        else:
+            gold = taskA_scorer.read_gold(gold_file)
+
+        missing = folds.keys() - gold.keys()
+        if missing:
+            logging.error("%d ids of %s are not in %s, for example: %s", len(missing), args.folds,
+                          gold_file, ", ".join(sorted(missing)[:3]))
+            sys.exit(EXIT_STATUS_FOLDS_MALFORMED)
+
+        for fold in range(k):
+            prediction_file = os.path.join(args.predictions_dir,
+                                           args.pattern.format(fold=fold, subtask=subtask))
+            if not os.path.isfile(prediction_file):
+                logging.error("Prediction file %s not found", prediction_file)
+                sys.exit(EXIT_STATUS_PREDICTION_FILE_MISSING)
+            fold_gold = {i: gold[i] for i in gold if folds.get(i) == fold}
+            jobs.append((subtask, fold, fold_gold, prediction_file))
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(score_fold, subtask, fold_gold, prediction_file)
+                   for subtask, _, fold_gold, prediction_file in jobs]
+
+    # scorers report errors with sys.exit, which surfaces here as SystemExit
+    status = 0
+    scores = {}
+    for (subtask, fold, _, prediction_file), future in zip(jobs, futures):
+        try:
+            scores[subtask, fold] = future.result()
+        except SystemExit as e:
+            logging.error("Scoring %s failed with exit status %s", prediction_file, e.code)
+            status = status or e.code
+
+    for subtask in args.subtasks:
+        _, metric = SUBTASKS[subtask]
+        values = [scores[subtask, fold] * 100 for fold in range(k) if (subtask, fold) in scores]
+        for fold in range(k):
+            if (subtask, fold) in scores:
+                print(f'{subtask} fold {fold} {metric}: {scores[subtask, fold]*100:.4f}')
+        if len(values) == k:
+            variance = statistics.variance(values) if k > 1 else 0.0
+            print(f'{subtask} mean {metric}: {statistics.mean(values):.4f}')
+            print(f'{subtask} variance {metric}: {variance:.4f}')
+
+    if status:
+        sys.exit(status)
+
+
+def main():
+    if args.command == 'split':
+        main_split()
+    else:
+        main_score()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='k-fold cross-validation over the SemEval 2020 Task 4 training data')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    split_parser = subparsers.add_parser('split', help='assign training instances to folds')
+    split_parser.add_argument('--train', default='ALL data/train.csv', help='combined training csv')
+    split_parser.add_argument('--training-dir', default=TRAINING_DIR,
+                              help='directory of the per-subtask training files')
+    split_parser.add_argument('--folds', '-f', required=True, help='fold assignment csv to write')
+    split_parser.add_argument('-k', type=int, default=5, help='number of folds')
+    split_parser.add_argument('--seed', type=int, default=0)
+    split_parser.add_argument('--force', action='store_true', help='overwrite an existing fold file')
+
+    score_parser = subparsers.add_parser('score', help='score per-fold prediction files')
+    score_parser.add_argument('--folds', '-f', required=True, help='fold assignment csv')
+    score_parser.add_argument('--training-dir', default=TRAINING_DIR,
+                              help='directory of the per-subtask training gold files')
+    score_parser.add_argument('--predictions-dir', '-p', required=True,
+                              help='directory holding the per-fold prediction files')
+    score_parser.add_argument('--pattern', default='fold{fold}/subtask{subtask}_answers.csv',
+                              help='path of a prediction file relative to --predictions-dir')
+    score_parser.add_argument('--subtasks', '-s', nargs='+', choices=sorted(SUBTASKS),
+                              default=sorted(SUBTASKS))
+    score_parser.add_argument('--jobs', '-j', type=int, default=None,
+                              help='number of worker processes')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    main()
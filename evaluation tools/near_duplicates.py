@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Near-duplicate and leakage detection between data splits.
+#
+# Sentences are reduced to word unigram/bigram shingle sets and sketched with
+# one-permutation MinHash (one hash per shingle, densified empty bins), so
+# building a signature costs O(#shingles) instead of O(#shingles * #hashes).
+# Signatures are banded into an LSH table; only colliding pairs are verified
+# with their exact Jaccard similarity.
+
+from typing import Iterator, List, Set, Tuple
+import argparse
+import csv
+import hashlib
+import logging
+import os
+import pickle
+import re
+import sys
+
+
+EXIT_STATUS_FILE_MALFORMED = 1
+
+COMBINED_HEADER = ['Correct Statement', 'Incorrect Statement', 'Right Reason1',
+                   'Confusing Reason1', 'Confusing Reason2', 'Right Reason2', 'Right Reason3']
+
+WORD_RE = re.compile(r"\w+")
+
+# offset added per rotation step when an empty bin borrows a value from a neighbour,
+# larger than any value a bin can hold itself for every num_perm, as shingle
+# hashes are 64 bits wide
+_ROTATION_OFFSET = 1 << 64
+
+
+def shingles(text: str) -> Set[int]:
+    """Returns the hashed word unigrams and bigrams of a lower-cased sentence."""
+    words = WORD_RE.findall(text.lower())
+    grams = set(words)
+    grams.update(' '.join(words[i:i+2]) for i in range(len(words) - 1))
+    return {int.from_bytes(hashlib.blake2b(g.encode('utf-8'), digest_size=8).digest(), 'little')
+            for g in grams}
+
+
+def minhash(shingle_set: Set[int], num_perm: int) -> Tuple[int, ...]:
+    """One-permutation MinHash: every shingle hash picks a bin and competes for its
+    minimum, empty bins are filled by rotation from the next non-empty bin."""
+    bins = [-1] * num_perm
+    for h in shingle_set:
+        j = h % num_perm
+        v = h // num_perm
+        if bins[j] < 0 or v < bins[j]:
+            bins[j] = v
+
+    if not shingle_set:
+        return tuple(bins)
+
+    # walk twice around the ring from the right so that every empty bin sees the
+    # nearest non-empty bin after it
+    signature = list(bins)
+    value = position = None
+    for j in range(2 * num_perm - 1, -1, -1):
+        v = bins[j % num_perm]
+        if v >= 0:
+            value, position = v, j
+        elif j < num_perm and value is not None:
+            signature[j] = value + (position - j) * _ROTATION_OFFSET
+    return tuple(signature)
+
+
+def jaccard(a: Set[int], b: Set[int]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class NearDuplicateIndex(object):
+    """LSH index over sentences, supporting incremental insertion.
+
+    Identical sentences share one entry; each entry keeps the list of
+    locations (file, line, column) it was seen at.
+    """
+
+    def __init__(self, num_perm: int = 64, bands: int = 16):
+        if num_perm % bands != 0:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.texts = []          # entry -> sentence
+        self.shingles = []       # entry -> shingle set
+        self.locations = []      # entry -> list of locations
+        self.entry_of = {}       # sentence -> entry
+        self.seen = set()        # locations already inserted
+        self.buckets = [{} for _ in range(bands)]
+
+    def __len__(self):
+        return len(self.texts)
+
+    def _band_keys(self, signature: Tuple[int, ...]) -> Iterator[Tuple[int, Tuple[int, ...]]]:
+        # a band whose bins all derive from a single shingle (one real bin plus bins
+        # densified from it) would bucket together every short sentence sharing one
+        # stop word, so such bands are left out of the table
+        for band in range(self.bands):
+            key = signature[band * self.rows:(band + 1) * self.rows]
+            if len({v % _ROTATION_OFFSET for v in key}) > 1:
+                yield band, key
+
+    def insert(self, location: Tuple[str, int, str], text: str) -> bool:
+        """Adds a sentence seen at `location`. Returns False if the location
+        was already indexed."""
+        if location in self.seen:
+            return False
+        self.seen.add(location)
+
+        entry = self.entry_of.get(text)
+        if entry is not None:
+            self.locations[entry].append(location)
+            return True
+
+        shingle_set = shingles(text)
+        entry = len(self.texts)
+        self.texts.append(text)
+        self.shingles.append(shingle_set)
+        self.locations.append([location])
+        self.entry_of[text] = entry
+
+        signature = minhash(shingle_set, self.num_perm)
+        for band, key in self._band_keys(signature):
+            self.buckets[band].setdefault(key, []).append(entry)
+        return True
+
+    def query(self, text: str, threshold: float) -> List[Tuple[float, int]]:
+        """Returns (similarity, entry) for every indexed sentence whose Jaccard
+        similarity with `text` is at least `threshold`, most similar first."""
+        shingle_set = shingles(text)
+        signature = minhash(shingle_set, self.num_perm)
+
+        candidates = set()
+        for band, key in self._band_keys(signature):
+            candidates.update(self.buckets[band].get(key, ()))
+
+        # |a & b| / |a | b| <= min(|a|, |b|) / max(|a|, |b|), so most candidates are
+        # rejected on their size alone
+        size = len(shingle_set)
+        low, high = size * threshold, size / threshold if threshold > 0 else float('inf')
+        matches = []
+        for entry in candidates:
+            other = self.shingles[entry]
+            if not low <= len(other) <= high:
+                continue
+            similarity = jaccard(shingle_set, other)
+            if similarity >= threshold:
+                matches.append((similarity, entry))
+        matches.sort(key=lambda m: (-m[0], m[1]))
+        return matches
+
+    def save(self, filename: str):
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(filename + '.tmp', filename)
+
+    @staticmethod
+    def load(filename: str) -> 'NearDuplicateIndex':
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+
+def read_sentences(filename: str, min_tokens: int) -> Iterator[Tuple[Tuple[str, int, str], str]]:
+    """Yields ((file, line, column), sentence) for every sentence column of a
+    combined csv, a subtask data file or a subtask C reference file.
+    Fields shorter than `min_tokens` words (ids, labels) are skipped."""
+    with open(filename, "rt", encoding="UTF-8", errors="replace") as f:
+        reader = csv.reader(f)
+        try:
+            header = None
+            for row in reader:
+                if reader.line_num == 1 and row and (row == COMBINED_HEADER or row[0] == 'id'):
+                    header = row
+                    continue
+                first = 0 if header == COMBINED_HEADER else 1
+                for column in range(first, len(row)):
+                    text = row[column]
+                    if len(WORD_RE.findall(text)) < min_tokens:
+                        continue
+                    name = header[column] if header and column < len(header) else str(column)
+                    yield (filename, reader.line_num, name), text
+        except csv.Error as e:
+            logging.error('file %s, line %d: %s', filename, reader.line_num, e)
+            sys.exit(EXIT_STATUS_FILE_MALFORMED)
+
+
+def main():
+    if args.index and os.path.exists(args.index):
+        index = NearDuplicateIndex.load(args.index)
+        if (args.num_perm, args.bands) != (index.num_perm, index.bands):
+            logging.warning("Index %s was built with --num-perm %d --bands %d, ignoring "
+                            "--num-perm %d --bands %d", args.index, index.num_perm, index.bands,
+                            args.num_perm, args.bands)
+    else:
+        index = NearDuplicateIndex(num_perm=args.num_perm, bands=args.bands)
+
+    added = 0
+    for filename in args.index_files:
+        for location, text in read_sentences(filename, args.min_tokens):
+            added += index.insert(location, text)
+    logging.info("Indexed %d new sentences, %d distinct in total", added, len(index))
+
+    if args.index:
+        index.save(args.index)
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['similarity', 'query_file', 'query_line', 'query_column', 'query_sentence',
+                     'index_file', 'index_line', 'index_column', 'index_sentence'])
+    overlaps = 0
+    for filename in args.query_files:
+        for (query_file, query_line, query_column), text in read_sentences(filename, args.min_tokens):
+            for similarity, entry in index.query(text, args.threshold):
+                for index_file, index_line, index_column in index.locations[entry]:
+                    writer.writerow([f'{similarity:.4f}', query_file, query_line, query_column, text,
+                                     index_file, index_line, index_column, index.texts[entry]])
+                overlaps += 1
+    logging.info("Found %d near-duplicate pairs with similarity >= %.2f", overlaps, args.threshold)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Near-duplicate detection between SemEval 2020 Task 4 data splits')
+    parser.add_argument('--index-files', '-i', nargs='*', default=['ALL data/train.csv'],
+                        help='csv files whose sentences are added to the index')
+    parser.add_argument('--query-files', '-q', nargs='*',
+                        default=['ALL data/test.csv', 'ALL data/Test Data/subtaskC_gold_answers.csv'],
+                        help='csv files whose sentences are looked up in the index')
+    parser.add_argument('--index', help='pickled index to load, extend with --index-files and save')
+    parser.add_argument('--threshold', '-t', type=float, default=0.7,
+                        help='minimum Jaccard similarity of shingle sets to report')
+    parser.add_argument('--num-perm', type=int, default=64, help='MinHash signature length')
+    parser.add_argument('--bands', type=int, default=16, help='number of LSH bands')
+    parser.add_argument('--min-tokens', type=int, default=3,
+                        help='skip fields with fewer words than this')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    main()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Append-only store of per-instance results across submissions.
+#
+# `add` scores one prediction file with the official scorer functions and
+# appends its per-instance outcomes: whether the answer is correct for
+# subtasks A and B, the n-gram match counts per order for subtask C. Every
+# subtask keeps one binary file per column; the rows of a submission are
+# contiguous and sorted by instance key, so a submission is a slice of the
+# columns and an instance is found in it with a binary search. Instance ids
+# and submissions are kept in small dictionary files next to the columns.
+#
+# `hardest`, `diff` and `history` answer from the stored columns alone, no
+# scorer is re-run.
+
+from typing import Dict, List, Tuple
+import argparse
+import array
+import bisect
+import csv
+import fcntl
+import logging
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import taskA_scorer  # noqa: E402
+import taskB_scorer  # noqa: E402
+import taskC_scorer  # noqa: E402
+
+
+EXIT_STATUS_STORE_MALFORMED = 1
+EXIT_STATUS_SUBMISSION_UNKNOWN = 2
+EXIT_STATUS_PREDICTIONS_EXTRA = 3
+EXIT_STATUS_PREDICTION_MISSING = 4
+EXIT_STATUS_SUBMISSION_EXISTS = 5
+
+MAX_ORDER = 4
+
+# subtask -> column name -> typecode
+COLUMNS = {
+    'A': {'instance': 'I', 'correct': 'B'},
+    'B': {'instance': 'I', 'correct': 'B'},
+    # matches and possible hold MAX_ORDER values per row
+    'C': {'instance': 'I', 'matches': 'I', 'possible': 'I', 'length': 'I', 'ref_length': 'I'},
+}
+WIDTHS = {'matches': MAX_ORDER, 'possible': MAX_ORDER}
+
+SUBMISSIONS_HEADER = ['name', 'subtask', 'tokenizer', 'start', 'count']
+
+
+def correctness(gold_labels: Dict[str, str], prediction_file: str, scorer) -> Dict[str, int]:
+    """Returns 1 for every correctly answered instance and 0 otherwise. Scored
+    prediction files are reduced to their top-scoring option."""
+    if scorer.is_scored_predictions(prediction_file, scorer.LABELS):
+        scored = scorer.read_scored_predictions(prediction_file, scorer.LABELS)
+        predictions = {i: scorer.LABELS[s.index(max(s))] for i, s in scored.items()}
+    else:
+        predictions = scorer.read_predictions(prediction_file)
+    check_coverage(gold_labels, predictions)
+    return {i: int(predictions[i] == answer) for i, answer in gold_labels.items()}
+
+
+def ngram_statistics(references: Dict[str, List[List[str]]],
+                     predictions: Dict[str, List[str]]) -> Dict[str, Tuple[List[int], List[int], int, int]]:
+    """Returns the sufficient BLEU statistics of every instance: matches and
+    possible matches per order, prediction length and shortest reference length."""
+    check_coverage(references, predictions)
+    statistics = {}
+    for instance_id, reference_sents in references.items():
+        translation = predictions[instance_id]
+        clipping_counts = taskC_scorer._clipping_counts(reference_sents, MAX_ORDER)
+        matches = [0] * MAX_ORDER
+        for ngram, count in taskC_scorer._get_ngrams(translation, MAX_ORDER).items():
+            if ngram in clipping_counts:
+                matches[len(ngram) - 1] += min(count, clipping_counts[ngram])
+        possible = [max(len(translation) - order, 0) for order in range(MAX_ORDER)]
+        statistics[instance_id] = (matches, possible, len(translation),
+                                   min(len(r) for r in reference_sents))
+    return statistics
+
+
+def check_coverage(gold: Dict[str, object], predictions: Dict[str, object]):
+    missing = gold.keys() - predictions.keys()
+    if missing:
+        logging.error("Missing prediction for instance '%s'.", sorted(missing)[0])
+        sys.exit(EXIT_STATUS_PREDICTION_MISSING)
+    extra = predictions.keys() - gold.keys()
+    if extra:
+        logging.error("Found %d extra predictions, for example: %s", len(extra),
+                      ", ".join(sorted(extra)[:3]))
+        sys.exit(EXIT_STATUS_PREDICTIONS_EXTRA)
+
+
+def sentence_bleu(matches: List[int], possible: List[int], length: int, ref_length: int) -> float:
+    """BLEU of a single instance, with the add-one smoothing of the scorer's
+    `smooth` option so that a missing 4-gram match does not zero it."""
+    if length == 0:
+        return 0.0
+    p_log_sum = sum(math.log((m + 1.) / (p + 1.)) for m, p in zip(matches, possible)) / MAX_ORDER
+    bp = 1. if length > ref_length else math.exp(1 - ref_length / length)
+    return math.exp(p_log_sum) * bp
+
+
+class ResultsStore(object):
+    """Directory holding the instance and submission dictionaries and the
+    column files of every subtask."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self.ids = []
+        ids_file = os.path.join(directory, 'ids.txt')
+        if os.path.exists(ids_file):
+            with open(ids_file, "rt", encoding="UTF-8") as f:
+                self.ids = f.read().split('\n')[:-1]
+        self.keys = {instance_id: key for key, instance_id in enumerate(self.ids)}
+
+        # (name, subtask) -> (tokenizer, start, count), in order of addition
+        self.submissions = {}
+        submissions_file = os.path.join(directory, 'submissions.csv')
+        if os.path.exists(submissions_file):
+            with open(submissions_file, "rt", encoding="UTF-8") as f:
+                reader = csv.reader(f)
+                if next(reader, None) != SUBMISSIONS_HEADER:
+                    logging.error("Unexpected header in %s", submissions_file)
+                    sys.exit(EXIT_STATUS_STORE_MALFORMED)
+                for name, subtask, tokenizer, start, count in reader:
+                    self.submissions[name, subtask] = (tokenizer, int(start), int(count))
+        self._columns = {}
+
+    def _column_file(self, subtask: str, column: str) -> str:
+        return os.path.join(self.directory, f'{subtask}.{column}.bin')
+
+    def rows(self, subtask: str) -> int:
+        """Number of committed rows; a crashed `add` may leave more on disk."""
+        return max((start + count for (_, s), (_, start, count) in self.submissions.items()
+                    if s == subtask), default=0)
+
+    def column(self, subtask: str, column: str) -> array.array:
+        if (subtask, column) not in self._columns:
+            values = array.array(COLUMNS[subtask][column])
+            length = self.rows(subtask) * WIDTHS.get(column, 1)
+            if length:
+                with open(self._column_file(subtask, column), 'rb') as f:
+                    try:
+                        values.fromfile(f, length)
+                    except EOFError:
+                        logging.error("%s is shorter than its submissions",
+                                      self._column_file(subtask, column))
+                        sys.exit(EXIT_STATUS_STORE_MALFORMED)
+            self._columns[subtask, column] = values
+        return self._columns[subtask, column]
+
+    def add(self, name: str, subtask: str, tokenizer: str, outcomes: Dict[str, object]):
+        """Appends the outcomes of one submission. Columns are written first and
+        the submission row last, so an interrupted add is never visible."""
+        if (name, subtask) in self.submissions:
+            logging.error("Submission %s of subtask %s is already stored", name, subtask)
+            sys.exit(EXIT_STATUS_SUBMISSION_EXISTS)
+
+        new_ids = [i for i in outcomes if i not in self.keys]
+        with open(os.path.join(self.directory, 'ids.txt'), "at", encoding="UTF-8") as f:
+            for instance_id in new_ids:
+                self.keys[instance_id] = len(self.ids)
+                self.ids.append(instance_id)
+                f.write(instance_id + '\n')
+
+        ordered = sorted(outcomes.items(), key=lambda item: self.keys[item[0]])
+        columns = {column: array.array(typecode) for column, typecode in COLUMNS[subtask].items()}
+        for instance_id, outcome in ordered:
+            columns['instance'].append(self.keys[instance_id])
+            if subtask == 'C':
+                matches, possible, length, ref_length = outcome
+                columns['matches'].extend(matches)
+                columns['possible'].extend(possible)
+                columns['length'].append(length)
+                columns['ref_length'].append(ref_length)
+            else:
+                columns['correct'].append(outcome)
+
+        start = self.rows(subtask)
+        for column, values in columns.items():
+            with open(self._column_file(subtask, column), 'ab') as f:
+                # drop rows an interrupted add left behind
+                f.truncate(start * WIDTHS.get(column, 1) * values.itemsize)
+                values.tofile(f)
+
+        submissions_file = os.path.join(self.directory, 'submissions.csv')
+        new_file = not os.path.exists(submissions_file)
+        with open(submissions_file, "at", encoding="UTF-8", newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            if new_file:
+                writer.writerow(SUBMISSIONS_HEADER)
+            writer.writerow([name, subtask, tokenizer, start, len(ordered)])
+        self.submissions[name, subtask] = (tokenizer, start, len(ordered))
+        self._columns.clear()
+
+    def names(self, subtask: str) -> List[str]:
+        return [name for name, s in self.submissions if s == subtask]
+
+    def segment(self, name: str, subtask: str) -> Tuple[int, int]:
+        try:
+            _, start, count = self.submissions[name, subtask]
+        except KeyError:
+            logging.error("No submission %s for subtask %s in %s", name, subtask, self.directory)
+            sys.exit(EXIT_STATUS_SUBMISSION_UNKNOWN)
+        return start, start + count
+
+    def score(self, subtask: str, row: int) -> float:
+        """Correctness (A, B) or sentence BLEU (C) of a stored row."""
+        if subtask != 'C':
+            return float(self.column(subtask, 'correct')[row])
+        span = slice(row * MAX_ORDER, (row + 1) * MAX_ORDER)
+        return sentence_bleu(self.column('C', 'matches')[span], self.column('C', 'possible')[span],
+                             self.column('C', 'length')[row], self.column('C', 'ref_length')[row])
+
+    def find(self, name: str, subtask: str, instance_id: str) -> int:
+        """Returns the row of `instance_id` in a submission, or -1."""
+        key = self.keys.get(instance_id)
+        if key is None:
+            return -1
+        start, stop = self.segment(name, subtask)
+        instances = self.column(subtask, 'instance')
+        row = bisect.bisect_left(instances, key, start, stop)
+        return row if row < stop and instances[row] == key else -1
+
+
+def main_add():
+    tokenizer = ''
+    if args.subtask == 'C':
+        tokenizer = args.tokenizer
+        references = taskC_scorer.read_references(args.gold, tokenizer, args.cache_dir,
+                                                   args.long_references)
+        predictions = taskC_scorer.read_predictions(args.predictions, tokenizer)
+        outcomes = ngram_statistics(references, predictions)
+    else:
+        scorer = taskA_scorer if args.subtask == 'A' else taskB_scorer
+        outcomes = correctness(scorer.read_gold(args.gold), args.predictions, scorer)
+
+    os.makedirs(args.store, exist_ok=True)
+    with open(os.path.join(args.store, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        store = ResultsStore(args.store)
+        store.add(args.name, args.subtask, tokenizer, outcomes)
+    logging.info("Stored %d results of %s for subtask %s", len(outcomes), args.name, args.subtask)
+
+
+def main_hardest():
+    store = ResultsStore(args.store)
+    instances = store.column(args.subtask, 'instance')
+    totals = [0.0] * len(store.ids)
+    counts = [0] * len(store.ids)
+    for row, key in enumerate(instances):
+        totals[key] += store.score(args.subtask, row)
+        counts[key] += 1
+
+    ranked = sorted((totals[key] / counts[key], -counts[key], store.ids[key])
+                    for key in range(len(store.ids)) if counts[key])
+    metric = 'BLEU' if args.subtask == 'C' else 'Accuracy'
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(['id', 'submissions', metric])
+    for mean, count, instance_id in ranked[:args.top]:
+        writer.writerow([instance_id, -count, f'{mean*100:.4f}'])
+
+
+def main_diff():
+    store = ResultsStore(args.store)
+    instances = store.column(args.subtask, 'instance')
+    start_a, stop_a = store.segment(args.first, args.subtask)
+    start_b, stop_b = store.segment(args.second, args.subtask)
+
+    # both segments are sorted by instance key, merge them
+    deltas = []
+    row_a, row_b = start_a, start_b
+    while row_a < stop_a and row_b < stop_b:
+        key_a, key_b = instances[row_a], instances[row_b]
+        if key_a == key_b:
+            score_a = store.score(args.subtask, row_a)
+            score_b = store.score(args.subtask, row_b)
+            if abs(score_b - score_a) >= args.min_delta:
+                deltas.append((score_b - score_a, store.ids[key_a], score_a, score_b))
+        row_a += key_a <= key_b
+        row_b += key_b <= key_a
+
+    deltas.sort(key=lambda d: (d[0], d[1]))
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(['id', args.first, args.second, 'delta'])
+    for delta, instance_id, score_a, score_b in deltas:
+        writer.writerow([instance_id, f'{score_a*100:.4f}', f'{score_b*100:.4f}', f'{delta*100:.4f}'])
+    logging.info("%d instances improved, %d got worse", sum(d[0] > 0 for d in deltas),
+                 sum(d[0] < 0 for d in deltas))
+
+
+def main_history():
+    store = ResultsStore(args.store)
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(['subtask', 'submission', 'score'])
+    for subtask in args.subtasks:
+        for name in store.names(subtask):
+            row = store.find(name, subtask, args.id)
+            if row >= 0:
+                writer.writerow([subtask, name, f'{store.score(subtask, row)*100:.4f}'])
+
+
+def main():
+    if args.command == 'add':
+        main_add()
+    elif args.command == 'hardest':
+        main_hardest()
+    elif args.command == 'diff':
+        main_diff()
+    else:
+        main_history()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Per-instance results of SemEval 2020 Task 4 submissions')
+    parser.add_argument('--store', required=True, help='directory of the results store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    add_parser = subparsers.add_parser('add', help='score a prediction file and store its results')
+    add_parser.add_argument('--subtask', '-s', choices=sorted(COLUMNS), required=True)
+    add_parser.add_argument('--name', '-n', required=True, help='name of the submission')
+    add_parser.add_argument('--gold', '-g', required=True, help='gold answers in csv format')
+    add_parser.add_argument('--predictions', '-p', required=True, help='predictions in csv format')
+    add_parser.add_argument('--tokenizer', choices=taskC_scorer.TOKENIZERS, default='whitespace',
+                            help='subtask C tokenization')
+    add_parser.add_argument('--cache-dir', help='directory to cache tokenized references in')
+    add_parser.add_argument('--long-references', action='store_true',
+                            help='subtask C gold file has one id,reference row per reference')
+
+    hardest_parser = subparsers.add_parser('hardest', help='instances with the lowest mean score')
+    hardest_parser.add_argument('--subtask', '-s', choices=sorted(COLUMNS), required=True)
+    hardest_parser.add_argument('--top', '-k', type=int, default=20, help='number of instances to list')
+
+    diff_parser = subparsers.add_parser('diff', help='per-instance changes between two submissions')
+    diff_parser.add_argument('--subtask', '-s', choices=sorted(COLUMNS), required=True)
+    diff_parser.add_argument('first', help='name of the first submission')
+    diff_parser.add_argument('second', help='name of the second submission')
+    diff_parser.add_argument('--min-delta', type=float, default=1e-9,
+                             help='smallest score change to report')
+
+    history_parser = subparsers.add_parser('history', help='results of one instance over all submissions')
+    history_parser.add_argument('id', help='instance id')
+    history_parser.add_argument('--subtasks', '-s', nargs='+', choices=sorted(COLUMNS),
+                                default=sorted(COLUMNS))
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Slice-based evaluation of subtask A, B and C submissions.
+#
+# `build` assigns every instance of a gold set to one group of each slice and
+# writes the assignment as one group index array per slice:
+#   length:     number of words of the false sentence;
+#   references: number of subtask C references;
+#   overlap:    highest word Jaccard similarity between the false sentence and
+#               any of its references;
+#   vocabulary: share of the false sentence's words that occur in train.csv.
+# `score` reduces every prediction file to per-instance sufficient statistics
+# (correctness for A and B, n-gram match counts for C) and sums them per group
+# of every slice in one pass, so all slices are scored without re-reading or
+# filtering any file.
+
+from typing import Dict, List, Tuple
+import argparse
+import array
+import csv
+import json
+import logging
+import math
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import results_store  # noqa: E402
+import taskA_scorer  # noqa: E402
+import taskB_scorer  # noqa: E402
+import taskC_scorer  # noqa: E402
+
+
+EXIT_STATUS_DATA_MALFORMED = 1
+EXIT_STATUS_SLICES_MALFORMED = 2
+
+WORD_RE = re.compile(r"\w+")
+
+# slice -> (upper bounds of all groups but the last, group names)
+SLICES = {
+    'length': ([6, 9, 12], ['1-6', '7-9', '10-12', '13+']),
+    'references': ([1, 2, 3], ['1', '2', '3', '4+']),
+    'overlap': ([0.2, 0.4], ['<=0.2', '0.2-0.4', '>0.4']),
+    'vocabulary': ([0.8, 0.999], ['<=80%', '80-99%', '100%']),
+}
+
+
+def words(text: str) -> List[str]:
+    return WORD_RE.findall(text.lower())
+
+
+def group(slice_name: str, value: float) -> int:
+    bounds, _ = SLICES[slice_name]
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            return i
+    return len(bounds)
+
+
+def read_vocabulary(train_file: str) -> set:
+    vocabulary = set()
+    with open(train_file, "rt", encoding="UTF-8", errors="replace") as f:
+        reader = csv.reader(f)
+        try:
+            next(reader, None)
+            for row in reader:
+                for field in row:
+                    vocabulary.update(words(field))
+        except csv.Error as e:
+            logging.error('file %s, line %d: %s', train_file, reader.line_num, e)
+            sys.exit(EXIT_STATUS_DATA_MALFORMED)
+    return vocabulary
+
+
+def read_false_sentences(data_file: str) -> Dict[str, str]:
+    sentences = {}
+    with open(data_file, "rt", encoding="UTF-8", errors="replace") as f:
+        reader = csv.reader(f)
+        try:
+            next(reader, None)
+            for row in reader:
+                if len(row) < 2:
+                    logging.error("Expected 2 fields in %s on line %d, found %d",
+                                  data_file, reader.line_num, len(row))
+                    sys.exit(EXIT_STATUS_DATA_MALFORMED)
+                sentences[row[0]] = row[1]
+        except csv.Error as e:
+            logging.error('file %s, line %d: %s', data_file, reader.line_num, e)
+            sys.exit(EXIT_STATUS_DATA_MALFORMED)
+    return sentences
+
+
+def build_slices(sentences: Dict[str, str], references: Dict[str, List[List[str]]],
+                 vocabulary: set) -> Dict[str, object]:
+    """Returns the ids of the gold set and, for every slice, the group index of
+    every id in the same order."""
+    missing = references.keys() - sentences.keys()
+    if missing:
+        logging.error("%d ids have references but no false sentence, for example: %s",
+                      len(missing), ", ".join(sorted(missing)[:3]))
+        sys.exit(EXIT_STATUS_DATA_MALFORMED)
+
+    ids = list(references)
+    indexes = {name: [] for name in SLICES}
+    for instance_id in ids:
+        sentence = words(sentences[instance_id])
+        sentence_set = set(sentence)
+        reason_sets = [set(words(' '.join(reference))) for reference in references[instance_id]]
+        overlap = max(len(sentence_set & reason) / len(sentence_set | reason) if sentence_set | reason
+                      else 0.0 for reason in reason_sets)
+        seen = sum(w in vocabulary for w in sentence) / len(sentence) if sentence else 1.0
+
+        indexes['length'].append(group('length', len(sentence)))
+        indexes['references'].append(group('references', len(reason_sets)))
+        indexes['overlap'].append(group('overlap', overlap))
+        indexes['vocabulary'].append(group('vocabulary', seen))
+    return {'ids': ids, 'slices': {name: {'groups': SLICES[name][1], 'index': indexes[name]}
+                                   for name in SLICES}}
+
+
+def read_slices(filename: str) -> Tuple[Dict[str, int], Dict[str, Tuple[List[str], array.array]]]:
+    """Returns the position of every id and, per slice, its group names and
+    group index array. The slice 'all' puts every instance in one group."""
+    try:
+        with open(filename, "rt", encoding="UTF-8") as f:
+            data = json.load(f)
+        positions = {instance_id: i for i, instance_id in enumerate(data['ids'])}
+        slices = {'all': (['all'], array.array('B', bytes(len(positions))))}
+        slices.update((name, (s['groups'], array.array('B', s['index'])))
+                      for name, s in data['slices'].items())
+    except (OSError, ValueError, KeyError) as e:
+        logging.error("Cannot read slice file %s: %s", filename, e)
+        sys.exit(EXIT_STATUS_SLICES_MALFORMED)
+    return positions, slices
+
+
+def corpus_bleu(statistics: List[float], max_order: int) -> float:
+    """BLEU from summed sufficient statistics: matches per order, possible
+    matches per order, prediction length and reference length."""
+    matches = statistics[:max_order]
+    possible = statistics[max_order:2 * max_order]
+    length, ref_length = statistics[2 * max_order:]
+    if min(possible) == 0 or min(matches) == 0:
+        return 0.0
+    geo_mean = math.exp(sum(math.log(m / p) for m, p in zip(matches, possible)) / max_order)
+    ratio = length / ref_length
+    return geo_mean * (1. if ratio > 1.0 else math.exp(1 - 1. / ratio))
+
+
+def instance_statistics(subtask: str, gold_file: str, prediction_file: str) -> Dict[str, List[float]]:
+    """Per-instance sufficient statistics of one submission."""
+    if subtask == 'C':
+        references = taskC_scorer.read_references(gold_file, args.tokenizer, args.cache_dir,
+                                                   args.long_references)
+        predictions = taskC_scorer.read_predictions(prediction_file, args.tokenizer)
+        return {instance_id: matches + possible + [length, ref_length]
+                for instance_id, (matches, possible, length, ref_length)
+                in results_store.ngram_statistics(references, predictions).items()}
+    scorer = taskA_scorer if subtask == 'A' else taskB_scorer
+    correct = results_store.correctness(scorer.read_gold(gold_file), prediction_file, scorer)
+    return {instance_id: [value] for instance_id, value in correct.items()}
+
+
+def score_slices(statistics: Dict[str, List[float]], positions: Dict[str, int],
+                 slices: Dict[str, Tuple[List[str], array.array]]) -> Dict[str, List[List[float]]]:
+    """Sums the statistics of every group of every slice in a single pass over
+    the instances. The last entry of each group's sums counts its instances."""
+    unknown = statistics.keys() - positions.keys()
+    if unknown:
+        logging.error("%d gold ids are not in the slice file, for example: %s",
+                      len(unknown), ", ".join(sorted(unknown)[:3]))
+        sys.exit(EXIT_STATUS_SLICES_MALFORMED)
+
+    width = len(next(iter(statistics.values())))
+    sums = {name: [[0.0] * (width + 1) for _ in groups] for name, (groups, _) in slices.items()}
+    targets = [(sums[name], index) for name, (_, index) in slices.items()]
+    for instance_id, values in statistics.items():
+        position = positions[instance_id]
+        for group_sums, index in targets:
+            total = group_sums[index[position]]
+            for i in range(width):
+                total[i] += values[i]
+            total[width] += 1
+    return sums
+
+
+def main_build():
+    sentences = read_false_sentences(args.data)
+    references = taskC_scorer.read_references(args.references, long_format=args.long_references)
+    vocabulary = read_vocabulary(args.train)
+    slices = build_slices(sentences, references, vocabulary)
+    with open(args.slices, "wt", encoding="UTF-8") as f:
+        json.dump(slices, f)
+    logging.info("Wrote %d slices over %d instances to %s", len(SLICES), len(slices['ids']), args.slices)
+
+
+def main_score():
+    positions, slices = read_slices(args.slices)
+    metric = 'BLEU' if args.subtask == 'C' else 'Accuracy'
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(['submission', 'slice', 'group', 'instances', metric])
+    for prediction_file in args.predictions:
+        statistics = instance_statistics(args.subtask, args.gold, prediction_file)
+        sums = score_slices(statistics, positions, slices)
+        for name, (groups, _) in slices.items():
+            for group_name, total in zip(groups, sums[name]):
+                count = int(total[-1])
+                if not count:
+                    continue
+                if args.subtask == 'C':
+                    score = corpus_bleu(total[:-1], results_store.MAX_ORDER)
+                else:
+                    score = total[0] / count
+                writer.writerow([prediction_file, name, group_name, count, f'{score*100:.4f}'])
+
+
+def main():
+    if args.command == 'build':
+        main_build()
+    else:
+        main_score()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Slice-based evaluation of SemEval 2020 Task 4 submissions')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='precompute the slice groups of a gold set')
+    build_parser.add_argument('--data', '-d', default='ALL data/Test Data/subtaskC_test_data.csv',
+                              help='subtask C data file holding the false sentences')
+    build_parser.add_argument('--references', '-r', default='ALL data/Test Data/subtaskC_gold_answers.csv',
+                              help='subtask C gold references')
+    build_parser.add_argument('--train', '-t', default='ALL data/train.csv',
+                              help='combined training csv the vocabulary is taken from')
+    build_parser.add_argument('--long-references', action='store_true',
+                              help='reference file has one id,reference row per reference')
+    build_parser.add_argument('--slices', '-s', required=True, help='slice file to write')
+
+    score_parser = subparsers.add_parser('score', help='score submissions per slice')
+    score_parser.add_argument('--slices', '-s', required=True, help='slice file written by build')
+    score_parser.add_argument('--subtask', choices=['A', 'B', 'C'], required=True)
+    score_parser.add_argument('--gold', '-g', required=True, help='gold answers in csv format')
+    score_parser.add_argument('--predictions', '-p', nargs='+', required=True,
+                              help='prediction files in csv format')
+    score_parser.add_argument('--tokenizer', choices=taskC_scorer.TOKENIZERS, default='whitespace',
+                              help='subtask C tokenization')
+    score_parser.add_argument('--cache-dir', help='directory to cache tokenized references in')
+    score_parser.add_argument('--long-references', action='store_true',
+                              help='subtask C gold file has one id,reference row per reference')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    main()
@@ -13,6 +13,7 @@ from typing import *
 import logging
 import sys
 import json
+import math
 
 
 EXIT_STATUS_ANSWERS_MALFORMED = 1
@@ -20,6 +21,9 @@ EXIT_STATUS_PREDICTIONS_MALFORMED = 2
 EXIT_STATUS_PREDICTIONS_EXTRA = 3
 EXIT_STATUS_PREDICTION_MISSING = 4
 
+# option labels in the order of the per-option scores of a scored prediction file
+LABELS = ['0', '1']
+
 
 def calculate_accuracy(gold_labels: Dict[str, str], predictions: Dict[str, List[str]]) -> float:
     score = 0.0
@@ -44,6 +48,70 @@ def calculate_accuracy(gold_labels: Dict[str, str], predictions: Dict[str, List[
     return score / len(gold_labels)
 
 
+def _to_probabilities(scores: List[float]) -> List[float]:
+    """Scores that already form a distribution (up to rounding) are renormalized,
+    anything else goes through a softmax."""
+    total = sum(scores)
+    if all(0.0 <= s <= 1.0 for s in scores) and abs(total - 1.0) < 1e-3:
+        return [s / total for s in scores]
+    top = max(scores)
+    exps = [math.exp(s - top) for s in scores]
+    total = sum(exps)
+    return [e / total for e in exps]
+
+
+def calculate_ranking_metrics(gold_labels: Dict[str, str], predictions: Dict[str, List[float]],
+                              labels: List[str], num_bins: int = 10) -> Dict[str, float]:
+    """Computes accuracy, mean reciprocal rank, log-loss and expected calibration
+    error from per-option scores. Options are ranked by score, ties keep file order."""
+    gold_index = []
+    rows = []
+    for instance_id, answer in gold_labels.items():
+        try:
+            scores = predictions[instance_id]
+        except KeyError:
+            logging.error("Missing prediction for question '%s'.", instance_id)
+            sys.exit(EXIT_STATUS_PREDICTION_MISSING)
+
+        if answer not in labels:
+            logging.error("Gold label %s of question '%s' is not one of %s",
+                          answer, instance_id, ", ".join(labels))
+            sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
+
+        gold_index.append(labels.index(answer))
+        rows.append(_to_probabilities(scores))
+
+        del predictions[instance_id]
+
+    if len(predictions) > 0:
+        logging.error("Found %d extra predictions, for example: %s", len(
+            predictions), ", ".join(list(predictions.keys())[:3]))
+        sys.exit(EXIT_STATUS_PREDICTIONS_EXTRA)
+
+    # column-wise passes over the whole file
+    n = len(rows)
+    gold_prob = [row[g] for row, g in zip(rows, gold_index)]
+    confidence = [max(row) for row in rows]
+    predicted = [row.index(c) for row, c in zip(rows, confidence)]
+    correct = [p == g for p, g in zip(predicted, gold_index)]
+    ranks = [1 + sum(1 for j, p in enumerate(row) if p > row[g] or (p == row[g] and j < g))
+             for row, g in zip(rows, gold_index)]
+
+    bin_correct = [0.0] * num_bins
+    bin_confidence = [0.0] * num_bins
+    for c, ok in zip(confidence, correct):
+        b = min(int(c * num_bins), num_bins - 1)
+        bin_correct[b] += ok
+        bin_confidence[b] += c
+
+    return {
+        'Accuracy': sum(correct) / n,
+        'MRR': sum(1.0 / r for r in ranks) / n,
+        'LogLoss': -sum(math.log(max(p, 1e-15)) for p in gold_prob) / n,
+        'ECE': sum(abs(bin_correct[b] - bin_confidence[b]) for b in range(num_bins)) / n,
+    }
+
+
 def read_gold(filename: str) -> Dict[str, str]:
     answers = {}
 
@@ -116,8 +184,75 @@ def read_predictions(filename: str) -> Dict[str, List[str]]:
     return predictions
 
 
+def is_scored_predictions(filename: str, labels: List[str]) -> bool:
+    """Scored files hold an id and one score per option in every row. Any other
+    first row, e.g. a hard label with a trailing comma, means a hard-label file."""
+    with open(filename, "rt", encoding="UTF-8", errors="replace") as f:
+        try:
+            row = next(csv.reader(f), [])
+        except csv.Error:
+            return False
+    if len(row) != len(labels) + 1:
+        return False
+    try:
+        [float(score) for score in row[1:]]
+    except ValueError:
+        return False
+    return True
+
+
+def read_scored_predictions(filename: str, labels: List[str]) -> Dict[str, List[float]]:
+    predictions = {}
+
+    with open(filename, "rt", encoding="UTF-8", errors="replace") as f:
+        reader = csv.reader(f)
+        try:
+            for row in reader:
+                if len(row) != len(labels) + 1:
+                    logging.error("Expected %d scores in file %s on line %d, found %d",
+                                  len(labels), filename, reader.line_num, len(row) - 1)
+                    sys.exit(EXIT_STATUS_PREDICTIONS_MALFORMED)
+                instance_id = row[0]
+
+                if instance_id in predictions:
+                    logging.error("Key %s repeated in file %s on line %d",
+                                  instance_id, filename, reader.line_num)
+                    sys.exit(EXIT_STATUS_PREDICTIONS_MALFORMED)
+
+                if instance_id == "":
+                    logging.error(
+                        "Key is empty in file %s on line %d", filename, reader.line_num)
+                    sys.exit(EXIT_STATUS_PREDICTIONS_MALFORMED)
+
+                try:
+                    scores = [float(score) for score in row[1:]]
+                except ValueError as e:
+                    logging.error("Invalid score in file %s on line %d: %s",
+                                  filename, reader.line_num, e)
+                    sys.exit(EXIT_STATUS_PREDICTIONS_MALFORMED)
+                if not all(math.isfinite(score) for score in scores):
+                    logging.error("Non-finite score in file %s on line %d",
+                                  filename, reader.line_num)
+                    sys.exit(EXIT_STATUS_PREDICTIONS_MALFORMED)
+                predictions[instance_id] = scores
+
+        except csv.Error as e:
+            logging.error('file %s, line %d: %s', filename, reader.line_num, e)
+            sys.exit(EXIT_STATUS_PREDICTIONS_MALFORMED)
+
+    return predictions
+
+
 def main():
     gold_labels = read_gold(args.gold_labels)
+    if is_scored_predictions(args.pred_labels, LABELS):
+        predictions = read_scored_predictions(args.pred_labels, LABELS)
+        metrics = calculate_ranking_metrics(gold_labels, predictions, LABELS)
+        print(f'Accuracy: {metrics["Accuracy"]*100:.4f}%')
+        print(f'MRR: {metrics["MRR"]*100:.4f}%')
+        print(f'LogLoss: {metrics["LogLoss"]:.4f}')
+        print(f'ECE: {metrics["ECE"]*100:.4f}%')
+        return
     pred_labels = read_predictions(args.pred_labels)
     accuracy = calculate_accuracy(gold_labels, pred_labels)
 
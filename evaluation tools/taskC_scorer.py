@@ -7,13 +7,20 @@
 # @Last Modified time: 2019-08-14 15:54:54
 # Modified from https://github.com/tensorflow/nmt/blob/master/nmt/scripts/bleu.py
 
-from typing import List, Dict
+from typing import List, Dict, Optional
 import csv
 import logging
 import sys
 import argparse
 import collections
+import hashlib
+import itertools
 import math
+import os
+import pickle
+import re
+import tempfile
+import unicodedata
 
 EXIT_STATUS_ANSWERS_MALFORMED = 1
 EXIT_STATUS_PREDICTIONS_MALFORMED = 2
@@ -33,12 +40,31 @@ def _get_ngrams(segment, max_order):
     """
     ngram_counts = collections.Counter()
     for order in range(1, max_order + 1):
-        for i in range(0, len(segment) - order + 1):
-            ngram = tuple(segment[i:i+order])
-            ngram_counts[ngram] += 1
+        ngram_counts.update(zip(*[segment[i:] for i in range(order)]))
     return ngram_counts
 
 
+def _clipping_counts(references, max_order):
+    """Computes the clipping count of every n-gram of a set of references,
+    i.e. its highest count in any single reference.
+
+    Identical references are merged first. All n-grams enter the result with
+    count 1 in a single dict construction; only the n-gram lists of a
+    reference that contain a repeated n-gram are counted and merged one by one.
+    """
+    distinct = set(map(tuple, references))
+    ngram_lists = [list(zip(*[reference[i:] for i in range(order)]))
+                   for reference in distinct for order in range(1, max_order + 1)]
+    clipping = dict.fromkeys(itertools.chain.from_iterable(ngram_lists), 1)
+    for ngrams in ngram_lists:
+        if len(set(ngrams)) == len(ngrams):
+            continue
+        for ngram, count in collections.Counter(ngrams).items():
+            if count > clipping[ngram]:
+                clipping[ngram] = count
+    return clipping
+
+
 def _compute_bleu(reference_corpus, translation_corpus, max_order=4, smooth=False):
     """Computes BLEU score of translated segments against one or more references.
     Args:
@@ -60,13 +86,11 @@ def _compute_bleu(reference_corpus, translation_corpus, max_order=4, smooth=Fals
         reference_length += min(len(r) for r in references)
         translation_length += len(translation)
 
-        merged_ref_ngram_counts = collections.Counter()
-        for reference in references:
-            merged_ref_ngram_counts |= _get_ngrams(reference, max_order)
+        clipping_counts = _clipping_counts(references, max_order)
         translation_ngram_counts = _get_ngrams(translation, max_order)
-        overlap = translation_ngram_counts & merged_ref_ngram_counts
-        for ngram in overlap:
-            matches_by_order[len(ngram)-1] += overlap[ngram]
+        for ngram, count in translation_ngram_counts.items():
+            if ngram in clipping_counts:
+                matches_by_order[len(ngram)-1] += min(count, clipping_counts[ngram])
         for order in range(1, max_order+1):
             possible_matches = len(translation) - order + 1
             if possible_matches > 0:
@@ -133,7 +157,114 @@ def calculate_bleu(references: Dict[str, List[List[str]]],
     return score
 
 
-def read_references(filename: str) -> List[List[List[str]]]:
+# mteval-v13a tokenization as in sacreBLEU; each line is padded with spaces,
+# so the rules never see the newlines a batch is joined with
+_TOKENIZE_13A_REGEXES = [
+    (re.compile(r'([\{-\~\[-\` -\&\(-\+\:-\@\/])'), r' \1 '),
+    (re.compile(r'([^0-9])([\.,])'), r'\1 \2 '),
+    (re.compile(r'([\.,])([^0-9])'), r' \1 \2'),
+    (re.compile(r'([0-9])(-)'), r'\1 \2 '),
+]
+
+_TOKENIZE_INTL_REGEXES = None
+
+
+def _unicode_classes(major_categories: str) -> Dict[str, str]:
+    """Builds regex character class bodies of all code points whose unicode
+    category starts with each of the given letters, in one pass."""
+    ranges = {major: [] for major in major_categories}
+    current = start = None
+    for code in range(sys.maxunicode + 2):
+        major = unicodedata.category(chr(code))[0] if code <= sys.maxunicode else None
+        if major == current:
+            continue
+        if current in ranges:
+            first, last = re.escape(chr(start)), re.escape(chr(code - 1))
+            ranges[current].append(first if start == code - 1 else f'{first}-{last}')
+        current, start = major, code
+    return {major: ''.join(r) for major, r in ranges.items()}
+
+
+def _intl_regexes():
+    """sacreBLEU's international tokenization rules. The stdlib re module has no
+    \\p{...} classes, so they are built from unicodedata once per process."""
+    global _TOKENIZE_INTL_REGEXES
+    if _TOKENIZE_INTL_REGEXES is None:
+        classes = _unicode_classes('PSN')
+        punctuation, symbol, number = classes['P'], classes['S'], classes['N']
+        # "not a number" also excludes the newline joining a batch, which
+        # then behaves like the end of a line
+        _TOKENIZE_INTL_REGEXES = [
+            (re.compile(f'([^{number}\\n])([{punctuation}])'), r'\1 \2 '),
+            (re.compile(f'([{punctuation}])([^{number}\\n])'), r' \1 \2'),
+            (re.compile(f'([{symbol}])'), r' \1 '),
+        ]
+    return _TOKENIZE_INTL_REGEXES
+
+
+def tokenize_batch(texts: List[str], tokenizer: str = 'whitespace') -> List[List[str]]:
+    """Tokenizes a list of sentences at once. The regex based tokenizers run
+    every rule a single time over the newline-joined batch."""
+    texts = [' '.join(text.splitlines()) for text in texts]
+    if tokenizer == 'whitespace':
+        return [text.split() for text in texts]
+    if tokenizer == 'char':
+        return [[c for c in text if not c.isspace()] for text in texts]
+    if tokenizer == '13a':
+        texts = [text.replace('&quot;', '"').replace('&amp;', '&').replace('&lt;', '<')
+                 .replace('&gt;', '>') for text in texts]
+        batch = ' ' + ' \n '.join(texts) + ' '
+        regexes = _TOKENIZE_13A_REGEXES
+    elif tokenizer == 'intl':
+        batch = '\n'.join(texts)
+        regexes = _intl_regexes()
+    else:
+        raise ValueError(f'Unknown tokenizer {tokenizer}')
+    for regex, replacement in regexes:
+        batch = regex.sub(replacement, batch)
+    return [line.split() for line in batch.split('\n')]
+
+
+TOKENIZERS = ['whitespace', '13a', 'intl', 'char']
+
+
+def _references_cache_file(filename: str, tokenizer: str, long_format: bool, cache_dir: str) -> str:
+    with open(filename, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    layout = 'long' if long_format else 'wide'
+    return os.path.join(cache_dir, f'references-{tokenizer}-{layout}-{digest}.pkl')
+
+
+def _load_cached_references(cache_file: str) -> Optional[Dict[str, List[List[str]]]]:
+    """Returns a cached reference entry, or None if there is none or it cannot
+    be read, in which case the caller rebuilds and overwrites it."""
+    try:
+        with open(cache_file, 'rb') as f:
+            references = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError,
+            IndexError, TypeError, ValueError) as e:
+        logging.warning("Ignoring unreadable reference cache %s: %s", cache_file, e)
+        return None
+    return references if isinstance(references, dict) else None
+
+
+def read_references(filename: str, tokenizer: str = 'whitespace',
+                    cache_dir: Optional[str] = None,
+                    long_format: bool = False) -> Dict[str, List[List[str]]]:
+    """Reads and tokenizes a reference file. Every row holds an id followed by
+    any number of references; with `long_format`, every row holds an id and a
+    single reference and an id is repeated for each of its references. With
+    `cache_dir`, the tokenized references are stored under a key derived from
+    the file contents, the layout and the tokenizer, so each gold file is only
+    normalized once."""
+    if cache_dir is not None:
+        cache_file = _references_cache_file(filename, tokenizer, long_format, cache_dir)
+        references = _load_cached_references(cache_file)
+        if references is not None:
+            return references
+
     references = {}
     with open(filename, "rt", encoding="UTF-8", errors="replace") as f:
         reader = csv.reader(f)
@@ -141,15 +272,18 @@ def read_references(filename: str) -> List[List[List[str]]]:
             for row in reader:
                 try:
                     instance_id = row[0]
-                    references_raw1 = row[1]
-                    references_raw2 = row[2]
-                    references_raw3 = row[3]
+                    references_raw = row[1:] if not long_format else [row[1]]
                 except IndexError as e:
                     logging.error(
                         "Error reading value from CSV file %s on line %d: %s", filename, reader.line_num, e)
                     sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
 
-                if instance_id in references:
+                if long_format and len(row) > 2:
+                    logging.error("Expected 2 fields in file %s on line %d, found %d",
+                                  filename, reader.line_num, len(row))
+                    sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
+
+                if instance_id in references and not long_format:
                     logging.error("Key %s repeated in file %s on line %d",
                                   instance_id, filename, reader.line_num)
                     sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
@@ -159,26 +293,46 @@ def read_references(filename: str) -> List[List[List[str]]]:
                         "Key is empty in file %s on line %d", filename, reader.line_num)
                     sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
 
-                tokens = []
-                for ref in [references_raw1, references_raw2, references_raw3]:
-                    if ref:
-                        tokens.append(ref.split())
+                raw = [ref for ref in references_raw if ref]
 
-                if len(tokens) == 0:
+                if len(raw) == 0 and not long_format:
                     logging.error(
                         "No reference sentence in file %s on line %d", filename, reader.line_num)
                     sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
 
-                references[instance_id] = tokens
+                references.setdefault(instance_id, []).extend(raw)
 
         except csv.Error as e:
             logging.error('file %s, line %d: %s', filename, reader.line_num, e)
             sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
 
+    if long_format:
+        empty = [instance_id for instance_id, raw in references.items() if not raw]
+        if empty:
+            logging.error("No reference sentence for key %s in file %s", empty[0], filename)
+            sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
+
+    tokens = iter(tokenize_batch([ref for raw in references.values() for ref in raw], tokenizer))
+    for instance_id, raw in references.items():
+        references[instance_id] = [next(tokens) for _ in raw]
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # a private temporary file per writer, so concurrent misses cannot
+        # interleave their writes
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(references, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
+
     return references
 
 
-def read_predictions(filename: str) -> List[List[str]]:
+def read_predictions(filename: str, tokenizer: str = 'whitespace') -> Dict[str, List[str]]:
     predictions = {}
     with open(filename, "rt", encoding="UTF-8", errors="replace") as f:
         reader = csv.reader(f)
@@ -206,19 +360,19 @@ def read_predictions(filename: str) -> List[List[str]]:
                     logging.warning("Key % s has empty prediction in file % s on line % d",
                                     instance_id, filename, reader.line_num)
 
-                tokens = prediction_raw.split()
-                predictions[instance_id] = tokens
+                predictions[instance_id] = prediction_raw
 
         except csv.Error as e:
             logging.error('file %s, line %d: %s', filename, reader.line_num, e)
             sys.exit(EXIT_STATUS_PREDICTIONS_MALFORMED)
 
-    return predictions
+    return dict(zip(predictions.keys(), tokenize_batch(list(predictions.values()), tokenizer)))
 
 
 def main():
-    references = read_references(args.references)
-    predictions = read_predictions(args.predictions)
+    references = read_references(args.references, args.tokenizer, args.cache_dir,
+                                 args.long_references)
+    predictions = read_predictions(args.predictions, args.tokenizer)
 
     bleu = calculate_bleu(references, predictions,
                           max_order=args.max_order, smooth=args.smooth)
@@ -237,5 +391,11 @@ if __name__ == '__main__':
         '--max_order', default=4, type=int, help='Maximum n-gram order to use when computing BLEU score')
     parser.add_argument('--smooth', action='store_true',
                         help='Whether or not to apply Lin et al. 2004 smoothing')
+    parser.add_argument('--tokenizer', default='whitespace', choices=TOKENIZERS,
+                        help='tokenization applied to references and predictions')
+    parser.add_argument('--cache-dir',
+                        help='directory to cache tokenized references in')
+    parser.add_argument('--long-references', action='store_true',
+                        help='reference file has one id,reference row per reference')
     args = parser.parse_args()
     main()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Cross-file consistency check for the whole `ALL data` tree.
+#
+# Every split is checked in its own worker process. Each file is loaded into
+# an id -> row index once, and agreement between files is checked with set
+# joins on those indexes, so all problems are collected and reported in one run.
+
+from typing import Dict, List, Optional
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import csv
+import logging
+import os
+import sys
+
+
+EXIT_STATUS_INCONSISTENT = 1
+
+# split name -> (directory, combined csv, {subtask: (data file, gold file)})
+SPLITS = {
+    'train': ('Training  Data', 'train.csv', {
+        'A': ('subtaskA_data_all.csv', 'subtaskA_answers_all.csv'),
+        'B': ('subtaskB_data_all.csv', 'subtaskB_answers_all.csv'),
+        'C': ('subtaskC_data_all.csv', 'subtaskC_answers_all.csv'),
+    }),
+    'dev': ('Dev Data', 'dev.csv', {
+        'A': ('subtaskA_dev_data.csv', 'subtaskA_gold_answers.csv'),
+        'B': ('subtaskB_dev_data.csv', 'subtaskB_gold_answers.csv'),
+        'C': ('subtaskC_dev_data.csv', 'subtaskC_gold_answers.csv'),
+    }),
+    'test': ('Test Data', 'test.csv', {
+        'A': ('subtaskA_test_data.csv', 'subtaskA_gold_answers.csv'),
+        'B': ('subtaskB_test_data.csv', 'subtaskB_gold_answers.csv'),
+        'C': ('subtaskC_test_data.csv', 'subtaskC_gold_answers.csv'),
+    }),
+    'trial': ('Trial Data', None, {
+        'A': ('taskA_trial_data.csv', 'taskA_trial_answer.csv'),
+        'B': ('taskB_trial_data.csv', 'taskB_trial_answer.csv'),
+        'C': ('taskC_trial_data.csv', 'taskC_trial_references.csv'),
+    }),
+}
+
+DATA_WIDTH = {'A': 3, 'B': 5, 'C': 2}
+GOLD_LABELS = {'A': {'0', '1'}, 'B': {'A', 'B', 'C'}}
+
+COMBINED_HEADER = ['Correct Statement', 'Incorrect Statement', 'Right Reason1',
+                   'Confusing Reason1', 'Confusing Reason2', 'Right Reason2', 'Right Reason3']
+
+
+def read_indexed(filename: str, header: bool, min_width: int,
+                 problems: List[str]) -> Optional[Dict[str, List[str]]]:
+    """Reads a csv file keyed by its first column.
+    Malformed rows, empty and repeated ids are appended to `problems` instead of
+    aborting, so that the rest of the tree can still be checked.
+    Returns None if the file cannot be read at all.
+    """
+    if not os.path.isfile(filename):
+        problems.append(f"{filename}: file not found")
+        return None
+
+    rows = {}
+    with open(filename, "rt", encoding="UTF-8", errors="replace") as f:
+        reader = csv.reader(f)
+        try:
+            if header:
+                next(reader, None)
+            for row in reader:
+                if len(row) < min_width:
+                    problems.append(f"{filename}, line {reader.line_num}: expected at least "
+                                    f"{min_width} fields, found {len(row)}")
+                    continue
+                instance_id = row[0]
+                if instance_id == "":
+                    problems.append(f"{filename}, line {reader.line_num}: empty key")
+                    continue
+                if instance_id in rows:
+                    problems.append(f"{filename}, line {reader.line_num}: key {instance_id} repeated")
+                    continue
+                rows[instance_id] = row
+        except csv.Error as e:
+            problems.append(f"{filename}, line {reader.line_num}: {e}")
+
+    return rows
+
+
+def read_combined(filename: str, problems: List[str]) -> Optional[List[List[str]]]:
+    if not os.path.isfile(filename):
+        problems.append(f"{filename}: file not found")
+        return None
+
+    rows = []
+    with open(filename, "rt", encoding="UTF-8", errors="replace") as f:
+        reader = csv.reader(f)
+        try:
+            header = next(reader, None)
+            if header != COMBINED_HEADER:
+                problems.append(f"{filename}: unexpected header {header}")
+            for row in reader:
+                if len(row) != len(COMBINED_HEADER):
+                    problems.append(f"{filename}, line {reader.line_num}: expected "
+                                    f"{len(COMBINED_HEADER)} fields, found {len(row)}")
+                    continue
+                rows.append(row)
+        except csv.Error as e:
+            problems.append(f"{filename}, line {reader.line_num}: {e}")
+
+    return rows
+
+
+def _compare_ids(name_a: str, ids_a: set, name_b: str, ids_b: set, problems: List[str]):
+    for instance_id in sorted(ids_a - ids_b):
+        problems.append(f"id {instance_id} in {name_a} but not in {name_b}")
+    for instance_id in sorted(ids_b - ids_a):
+        problems.append(f"id {instance_id} in {name_b} but not in {name_a}")
+
+
+def _reasons_match(instance_id: str, record: List[str],
+                   data: Dict[str, Dict[str, List[str]]], gold: Dict[str, Dict[str, List[str]]]) -> bool:
+    """Whether the B options and C references of an instance, where present,
+    are the reasons of a combined record."""
+    right1, confusing1, confusing2, right2, right3 = record[2:]
+    if instance_id in data.get('B', {}):
+        if sorted(data['B'][instance_id][2:5]) != sorted([right1, confusing1, confusing2]):
+            return False
+    if instance_id in gold.get('C', {}):
+        if gold['C'][instance_id][1:4] != [right1, right2, right3]:
+            return False
+    return True
+
+
+def _check_combined(combined_file: str, files: Dict[str, str],
+                    data: Dict[str, Dict[str, List[str]]], gold: Dict[str, Dict[str, List[str]]],
+                    problems: List[str]):
+    """Joins every subtask A instance to its combined record on the
+    (incorrect, correct) statement pair, then checks B options and C references
+    against the reasons of that record."""
+    combined = read_combined(combined_file, problems)
+    if combined is None or 'A' not in data or 'A' not in gold:
+        return
+
+    index = {}
+    for line, row in enumerate(combined, start=2):
+        index.setdefault((row[1], row[0]), []).append(line)
+
+    joined = {}
+    used = set()
+    for instance_id in sorted(data['A'].keys() & gold['A'].keys()):
+        label = gold['A'][instance_id][1]
+        if label not in GOLD_LABELS['A']:
+            continue
+        row = data['A'][instance_id]
+        false_sent = row[1 + int(label)]
+        true_sent = row[2 - int(label)]
+        lines = index.get((false_sent, true_sent))
+        if not lines:
+            problems.append(f"id {instance_id} in {files['A']} has no matching record in {combined_file}")
+            continue
+        # several records can share a statement pair; take the first one whose
+        # reasons match, preferring records no other instance was joined to
+        candidates = [line for line in lines if line not in used] + [line for line in lines if line in used]
+        line = next((line for line in candidates
+                     if _reasons_match(instance_id, combined[line - 2], data, gold)), candidates[0])
+        joined[instance_id] = line
+        used.add(line)
+
+    unused = set(range(2, len(combined) + 2)) - used
+    for line in sorted(unused):
+        problems.append(f"{combined_file}, line {line}: record is not used by any subtask A instance")
+
+    for instance_id, line in sorted(joined.items()):
+        record = combined[line - 2]
+        right1, confusing1, confusing2, right2, right3 = record[2:]
+
+        if instance_id in data.get('B', {}) and instance_id in gold.get('B', {}):
+            options = data['B'][instance_id][2:5]
+            label = gold['B'][instance_id][1]
+            if sorted(options) != sorted([right1, confusing1, confusing2]):
+                problems.append(f"id {instance_id}: options in {files['B']} differ from "
+                                f"{combined_file}, line {line}")
+            elif label in GOLD_LABELS['B'] and options['ABC'.index(label)] != right1:
+                problems.append(f"id {instance_id}: gold option {label} is not Right Reason1 "
+                                f"of {combined_file}, line {line}")
+
+        if instance_id in gold.get('C', {}):
+            references = gold['C'][instance_id][1:4]
+            if references != [right1, right2, right3]:
+                problems.append(f"id {instance_id}: references in {files['C_gold']} differ from "
+                                f"Right Reason1-3 of {combined_file}, line {line}")
+
+
+def check_split(data_dir: str, split: str) -> List[str]:
+    """Runs every check for one split and returns the problems found."""
+    directory, combined_name, layout = SPLITS[split]
+    split_dir = os.path.join(data_dir, directory)
+    problems = []
+
+    data = {}
+    gold = {}
+    files = {}
+    for subtask, (data_name, gold_name) in layout.items():
+        data_file = os.path.join(split_dir, data_name)
+        gold_file = os.path.join(split_dir, gold_name)
+        files[subtask] = data_file
+        files[subtask + '_gold'] = gold_file
+
+        rows = read_indexed(data_file, True, DATA_WIDTH[subtask], problems)
+        if rows is not None:
+            data[subtask] = rows
+        rows = read_indexed(gold_file, False, 2, problems)
+        if rows is not None:
+            gold[subtask] = rows
+            for instance_id, row in rows.items():
+                if subtask in GOLD_LABELS and row[1] not in GOLD_LABELS[subtask]:
+                    problems.append(f"{gold_file}: id {instance_id} has invalid label {row[1]!r}")
+                if subtask == 'C' and not any(row[1:]):
+                    problems.append(f"{gold_file}: id {instance_id} has no reference sentence")
+
+        if subtask in data and subtask in gold:
+            _compare_ids(data_file, data[subtask].keys(), gold_file, gold[subtask].keys(), problems)
+
+    # the same instances must appear in every subtask
+    subtasks = sorted(data)
+    for other in subtasks[1:]:
+        _compare_ids(files[subtasks[0]], data[subtasks[0]].keys(),
+                     files[other], data[other].keys(), problems)
+
+    # the nonsensical statement must be the same in all three subtasks
+    if 'A' in data and 'A' in gold:
+        for instance_id in sorted(data['A'].keys() & gold['A'].keys()):
+            label = gold['A'][instance_id][1]
+            if label not in GOLD_LABELS['A']:
+                continue
+            false_sent = data['A'][instance_id][1 + int(label)]
+            for subtask in ('B', 'C'):
+                row = data.get(subtask, {}).get(instance_id)
+                if row is not None and row[1] != false_sent:
+                    problems.append(f"id {instance_id}: FalseSent in {files[subtask]} is not the "
+                                    f"nonsensical statement of {files['A']}")
+
+    if combined_name is not None:
+        _check_combined(os.path.join(data_dir, combined_name),
+                        files, data, gold, problems)
+
+    return problems
+
+
+def main():
+    splits = args.splits or list(SPLITS)
+    for split in splits:
+        if split not in SPLITS:
+            logging.error("Unknown split %s, expected one of %s", split, ", ".join(SPLITS))
+            sys.exit(EXIT_STATUS_INCONSISTENT)
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(check_split, [args.data_dir] * len(splits), splits))
+
+    total = 0
+    for split, problems in zip(splits, results):
+        print(f'{split}: {len(problems)} problem(s)')
+        for problem in problems:
+            print(f'  {problem}')
+        total += len(problems)
+
+    if total > 0:
+        sys.exit(EXIT_STATUS_INCONSISTENT)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Cross-file consistency check for the SemEval 2020 Task 4 data')
+    parser.add_argument('--data-dir', '-d', default='ALL data',
+                        help='root of the data tree')
+    parser.add_argument('--splits', '-s', nargs='*',
+                        help='splits to check (default: all)')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='number of worker processes')
+    args = parser.parse_args()
+    main()
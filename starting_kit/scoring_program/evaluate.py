@@ -7,7 +7,7 @@
 # @Last Modified time: 2019-08-14 15:26:48
 # Modified from https://github.com/allenai/aristo-leaderboard/blob/master/openbookqa/evaluator/evaluator.py
 
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 import argparse
 import csv
 import logging
@@ -16,6 +16,14 @@ import json
 import os
 import math
 import collections
+import hashlib
+import itertools
+import pickle
+import re
+import tempfile
+import time
+import unicodedata
+import contextlib
 
 
 EXIT_STATUS_ANSWERS_MALFORMED = 1
@@ -23,6 +31,12 @@ EXIT_STATUS_PREDICTIONS_MALFORMED = 2
 EXIT_STATUS_PREDICTIONS_EXTRA = 3
 EXIT_STATUS_PREDICTION_MISSING = 4
 EXIT_STATUS_WRONG_FILE = 5
+EXIT_STATUS_RESOURCE_LIMIT = 6
+EXIT_STATUS_SCORER_ERROR = 7
+
+# option labels in the order of the per-option scores of a scored prediction file
+LABELS_TASKA = ['0', '1']
+LABELS_TASKB = ['A', 'B', 'C']
 
 
 def calculate_accuracy(gold_labels: Dict[str, str], predictions: Dict[str, List[str]]) -> float:
@@ -48,6 +62,70 @@ def calculate_accuracy(gold_labels: Dict[str, str], predictions: Dict[str, List[
     return score / len(gold_labels)
 
 
+def _to_probabilities(scores: List[float]) -> List[float]:
+    """Scores that already form a distribution (up to rounding) are renormalized,
+    anything else goes through a softmax."""
+    total = sum(scores)
+    if all(0.0 <= s <= 1.0 for s in scores) and abs(total - 1.0) < 1e-3:
+        return [s / total for s in scores]
+    top = max(scores)
+    exps = [math.exp(s - top) for s in scores]
+    total = sum(exps)
+    return [e / total for e in exps]
+
+
+def calculate_ranking_metrics(gold_labels: Dict[str, str], predictions: Dict[str, List[float]],
+                              labels: List[str], num_bins: int = 10) -> Dict[str, float]:
+    """Computes accuracy, mean reciprocal rank, log-loss and expected calibration
+    error from per-option scores. Options are ranked by score, ties keep file order."""
+    gold_index = []
+    rows = []
+    for instance_id, answer in gold_labels.items():
+        try:
+            scores = predictions[instance_id]
+        except KeyError:
+            logging.error("Missing prediction for question '%s'.", instance_id)
+            sys.exit(EXIT_STATUS_PREDICTION_MISSING)
+
+        if answer not in labels:
+            logging.error("Gold label %s of question '%s' is not one of %s",
+                          answer, instance_id, ", ".join(labels))
+            sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
+
+        gold_index.append(labels.index(answer))
+        rows.append(_to_probabilities(scores))
+
+        del predictions[instance_id]
+
+    if len(predictions) > 0:
+        logging.error("Found %d extra predictions, for example: %s", len(
+            predictions), ", ".join(list(predictions.keys())[:3]))
+        sys.exit(EXIT_STATUS_PREDICTIONS_EXTRA)
+
+    # column-wise passes over the whole file
+    n = len(rows)
+    gold_prob = [row[g] for row, g in zip(rows, gold_index)]
+    confidence = [max(row) for row in rows]
+    predicted = [row.index(c) for row, c in zip(rows, confidence)]
+    correct = [p == g for p, g in zip(predicted, gold_index)]
+    ranks = [1 + sum(1 for j, p in enumerate(row) if p > row[g] or (p == row[g] and j < g))
+             for row, g in zip(rows, gold_index)]
+
+    bin_correct = [0.0] * num_bins
+    bin_confidence = [0.0] * num_bins
+    for c, ok in zip(confidence, correct):
+        b = min(int(c * num_bins), num_bins - 1)
+        bin_correct[b] += ok
+        bin_confidence[b] += c
+
+    return {
+        'Accuracy': sum(correct) / n,
+        'MRR': sum(1.0 / r for r in ranks) / n,
+        'LogLoss': -sum(math.log(max(p, 1e-15)) for p in gold_prob) / n,
+        'ECE': sum(abs(bin_correct[b] - bin_confidence[b]) for b in range(num_bins)) / n,
+    }
+
+
 def _get_ngrams(segment, max_order):
     """Extracts all n-grams upto a given maximum order from an input segment.
     Args:
@@ -60,12 +138,31 @@ def _get_ngrams(segment, max_order):
     """
     ngram_counts = collections.Counter()
     for order in range(1, max_order + 1):
-        for i in range(0, len(segment) - order + 1):
-            ngram = tuple(segment[i:i+order])
-            ngram_counts[ngram] += 1
+        ngram_counts.update(zip(*[segment[i:] for i in range(order)]))
     return ngram_counts
 
 
+def _clipping_counts(references, max_order):
+    """Computes the clipping count of every n-gram of a set of references,
+    i.e. its highest count in any single reference.
+
+    Identical references are merged first. All n-grams enter the result with
+    count 1 in a single dict construction; only the n-gram lists of a
+    reference that contain a repeated n-gram are counted and merged one by one.
+    """
+    distinct = set(map(tuple, references))
+    ngram_lists = [list(zip(*[reference[i:] for i in range(order)]))
+                   for reference in distinct for order in range(1, max_order + 1)]
+    clipping = dict.fromkeys(itertools.chain.from_iterable(ngram_lists), 1)
+    for ngrams in ngram_lists:
+        if len(set(ngrams)) == len(ngrams):
+            continue
+        for ngram, count in collections.Counter(ngrams).items():
+            if count > clipping[ngram]:
+                clipping[ngram] = count
+    return clipping
+
+
 def _compute_bleu(reference_corpus, translation_corpus, max_order=4, smooth=False):
     """Computes BLEU score of translated segments against one or more references.
     Args:
@@ -87,13 +184,11 @@ def _compute_bleu(reference_corpus, translation_corpus, max_order=4, smooth=Fals
         reference_length += min(len(r) for r in references)
         translation_length += len(translation)
 
-        merged_ref_ngram_counts = collections.Counter()
-        for reference in references:
-            merged_ref_ngram_counts |= _get_ngrams(reference, max_order)
+        clipping_counts = _clipping_counts(references, max_order)
         translation_ngram_counts = _get_ngrams(translation, max_order)
-        overlap = translation_ngram_counts & merged_ref_ngram_counts
-        for ngram in overlap:
-            matches_by_order[len(ngram)-1] += overlap[ngram]
+        for ngram, count in translation_ngram_counts.items():
+            if ngram in clipping_counts:
+                matches_by_order[len(ngram)-1] += min(count, clipping_counts[ngram])
         for order in range(1, max_order+1):
             possible_matches = len(translation) - order + 1
             if possible_matches > 0:
@@ -232,7 +327,175 @@ def read_predictions_taskAB(filename: str) -> Dict[str, List[str]]:
     return predictions
 
 
-def read_references_taskC(filename: str) -> List[List[List[str]]]:
+def is_scored_predictions(filename: str, labels: List[str]) -> bool:
+    """Scored files hold an id and one score per option in every row. Any other
+    first row, e.g. a hard label with a trailing comma, means a hard-label file."""
+    with open(filename, "rt", encoding="UTF-8", errors="replace") as f:
+        try:
+            row = next(csv.reader(f), [])
+        except csv.Error:
+            return False
+    if len(row) != len(labels) + 1:
+        return False
+    try:
+        [float(score) for score in row[1:]]
+    except ValueError:
+        return False
+    return True
+
+
+def read_scored_predictions_taskAB(filename: str, labels: List[str]) -> Dict[str, List[float]]:
+    predictions = {}
+
+    with open(filename, "rt", encoding="UTF-8", errors="replace") as f:
+        reader = csv.reader(f)
+        try:
+            for row in reader:
+                if len(row) != len(labels) + 1:
+                    logging.error("Expected %d scores in file %s on line %d, found %d",
+                                  len(labels), filename, reader.line_num, len(row) - 1)
+                    sys.exit(EXIT_STATUS_PREDICTIONS_MALFORMED)
+                instance_id = row[0]
+
+                if instance_id in predictions:
+                    logging.error("Key %s repeated in file %s on line %d",
+                                  instance_id, filename, reader.line_num)
+                    sys.exit(EXIT_STATUS_PREDICTIONS_MALFORMED)
+
+                if instance_id == "":
+                    logging.error(
+                        "Key is empty in file %s on line %d", filename, reader.line_num)
+                    sys.exit(EXIT_STATUS_PREDICTIONS_MALFORMED)
+
+                try:
+                    scores = [float(score) for score in row[1:]]
+                except ValueError as e:
+                    logging.error("Invalid score in file %s on line %d: %s",
+                                  filename, reader.line_num, e)
+                    sys.exit(EXIT_STATUS_PREDICTIONS_MALFORMED)
+                if not all(math.isfinite(score) for score in scores):
+                    logging.error("Non-finite score in file %s on line %d",
+                                  filename, reader.line_num)
+                    sys.exit(EXIT_STATUS_PREDICTIONS_MALFORMED)
+                predictions[instance_id] = scores
+
+        except csv.Error as e:
+            logging.error('file %s, line %d: %s', filename, reader.line_num, e)
+            sys.exit(EXIT_STATUS_PREDICTIONS_MALFORMED)
+
+    return predictions
+
+
+# mteval-v13a tokenization as in sacreBLEU; each line is padded with spaces,
+# so the rules never see the newlines a batch is joined with
+_TOKENIZE_13A_REGEXES = [
+    (re.compile(r'([\{-\~\[-\` -\&\(-\+\:-\@\/])'), r' \1 '),
+    (re.compile(r'([^0-9])([\.,])'), r'\1 \2 '),
+    (re.compile(r'([\.,])([^0-9])'), r' \1 \2'),
+    (re.compile(r'([0-9])(-)'), r'\1 \2 '),
+]
+
+_TOKENIZE_INTL_REGEXES = None
+
+
+def _unicode_classes(major_categories: str) -> Dict[str, str]:
+    """Builds regex character class bodies of all code points whose unicode
+    category starts with each of the given letters, in one pass."""
+    ranges = {major: [] for major in major_categories}
+    current = start = None
+    for code in range(sys.maxunicode + 2):
+        major = unicodedata.category(chr(code))[0] if code <= sys.maxunicode else None
+        if major == current:
+            continue
+        if current in ranges:
+            first, last = re.escape(chr(start)), re.escape(chr(code - 1))
+            ranges[current].append(first if start == code - 1 else f'{first}-{last}')
+        current, start = major, code
+    return {major: ''.join(r) for major, r in ranges.items()}
+
+
+def _intl_regexes():
+    """sacreBLEU's international tokenization rules. The stdlib re module has no
+    \\p{...} classes, so they are built from unicodedata once per process."""
+    global _TOKENIZE_INTL_REGEXES
+    if _TOKENIZE_INTL_REGEXES is None:
+        classes = _unicode_classes('PSN')
+        punctuation, symbol, number = classes['P'], classes['S'], classes['N']
+        # "not a number" also excludes the newline joining a batch, which
+        # then behaves like the end of a line
+        _TOKENIZE_INTL_REGEXES = [
+            (re.compile(f'([^{number}\\n])([{punctuation}])'), r'\1 \2 '),
+            (re.compile(f'([{punctuation}])([^{number}\\n])'), r' \1 \2'),
+            (re.compile(f'([{symbol}])'), r' \1 '),
+        ]
+    return _TOKENIZE_INTL_REGEXES
+
+
+def tokenize_batch(texts: List[str], tokenizer: str = 'whitespace') -> List[List[str]]:
+    """Tokenizes a list of sentences at once. The regex based tokenizers run
+    every rule a single time over the newline-joined batch."""
+    texts = [' '.join(text.splitlines()) for text in texts]
+    if tokenizer == 'whitespace':
+        return [text.split() for text in texts]
+    if tokenizer == 'char':
+        return [[c for c in text if not c.isspace()] for text in texts]
+    if tokenizer == '13a':
+        texts = [text.replace('&quot;', '"').replace('&amp;', '&').replace('&lt;', '<')
+                 .replace('&gt;', '>') for text in texts]
+        batch = ' ' + ' \n '.join(texts) + ' '
+        regexes = _TOKENIZE_13A_REGEXES
+    elif tokenizer == 'intl':
+        batch = '\n'.join(texts)
+        regexes = _intl_regexes()
+    else:
+        raise ValueError(f'Unknown tokenizer {tokenizer}')
+    for regex, replacement in regexes:
+        batch = regex.sub(replacement, batch)
+    return [line.split() for line in batch.split('\n')]
+
+
+TOKENIZERS = ['whitespace', '13a', 'intl', 'char']
+
+
+def _references_cache_file(filename: str, tokenizer: str, long_format: bool, cache_dir: str) -> str:
+    with open(filename, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    layout = 'long' if long_format else 'wide'
+    return os.path.join(cache_dir, f'references-{tokenizer}-{layout}-{digest}.pkl')
+
+
+def _load_cached_references(cache_file: str) -> Optional[Dict[str, List[List[str]]]]:
+    """Returns a cached reference entry, or None if there is none or it cannot
+    be read, in which case the caller rebuilds and overwrites it."""
+    try:
+        with open(cache_file, 'rb') as f:
+            references = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError,
+            IndexError, TypeError, ValueError) as e:
+        logging.warning("Ignoring unreadable reference cache %s: %s", cache_file, e)
+        return None
+    return references if isinstance(references, dict) else None
+
+
+def read_references_taskC(filename: str, tokenizer: str = 'whitespace',
+                          cache_dir: Optional[str] = None,
+                          long_format: bool = False) -> Dict[str, List[List[str]]]:
+    """Reads and tokenizes a reference file. Every row holds an id followed by
+    any number of references; with `long_format`, every row holds an id and a
+    single reference and an id is repeated for each of its references. With
+    `cache_dir`, the tokenized references are stored under a key derived from
+    the file contents, the layout and the tokenizer, so each gold file is only
+    normalized once."""
+    if cache_dir is not None:
+        cache_file = _references_cache_file(filename, tokenizer, long_format, cache_dir)
+        references = _load_cached_references(cache_file)
+        if references is not None:
+            METRICS.inc('semeval_gold_cache_total', subtask='C', result='hit')
+            return references
+        METRICS.inc('semeval_gold_cache_total', subtask='C', result='miss')
+
     references = {}
     with open(filename, "rt", encoding="UTF-8", errors="replace") as f:
         reader = csv.reader(f)
@@ -240,15 +503,18 @@ def read_references_taskC(filename: str) -> List[List[List[str]]]:
             for row in reader:
                 try:
                     instance_id = row[0]
-                    references_raw1 = row[1]
-                    references_raw2 = row[2]
-                    references_raw3 = row[3]
+                    references_raw = row[1:] if not long_format else [row[1]]
                 except IndexError as e:
                     logging.error(
                         "Error reading value from CSV file %s on line %d: %s", filename, reader.line_num, e)
                     sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
 
-                if instance_id in references:
+                if long_format and len(row) > 2:
+                    logging.error("Expected 2 fields in file %s on line %d, found %d",
+                                  filename, reader.line_num, len(row))
+                    sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
+
+                if instance_id in references and not long_format:
                     logging.error("Key %s repeated in file %s on line %d",
                                   instance_id, filename, reader.line_num)
                     sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
@@ -258,26 +524,46 @@ def read_references_taskC(filename: str) -> List[List[List[str]]]:
                         "Key is empty in file %s on line %d", filename, reader.line_num)
                     sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
 
-                tokens = []
-                for ref in [references_raw1, references_raw2, references_raw3]:
-                    if ref:
-                        tokens.append(ref.split())
+                raw = [ref for ref in references_raw if ref]
 
-                if len(tokens) == 0:
+                if len(raw) == 0 and not long_format:
                     logging.error(
                         "No reference sentence in file %s on line %d", filename, reader.line_num)
                     sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
 
-                references[instance_id] = tokens
+                references.setdefault(instance_id, []).extend(raw)
 
         except csv.Error as e:
             logging.error('file %s, line %d: %s', filename, reader.line_num, e)
             sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
 
+    if long_format:
+        empty = [instance_id for instance_id, raw in references.items() if not raw]
+        if empty:
+            logging.error("No reference sentence for key %s in file %s", empty[0], filename)
+            sys.exit(EXIT_STATUS_ANSWERS_MALFORMED)
+
+    tokens = iter(tokenize_batch([ref for raw in references.values() for ref in raw], tokenizer))
+    for instance_id, raw in references.items():
+        references[instance_id] = [next(tokens) for _ in raw]
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # a private temporary file per writer, so concurrent misses cannot
+        # interleave their writes
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(references, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
+
     return references
 
 
-def read_predictions_taskC(filename: str) -> List[List[str]]:
+def read_predictions_taskC(filename: str, tokenizer: str = 'whitespace') -> Dict[str, List[str]]:
     predictions = {}
     with open(filename, "rt", encoding="UTF-8", errors="replace") as f:
         reader = csv.reader(f)
@@ -305,20 +591,370 @@ def read_predictions_taskC(filename: str) -> List[List[str]]:
                     logging.warning("Key % s has empty prediction in file % s on line % d",
                                     instance_id, filename, reader.line_num)
 
-                tokens = prediction_raw.split()
-                predictions[instance_id] = tokens
+                predictions[instance_id] = prediction_raw
 
         except csv.Error as e:
             logging.error('file %s, line %d: %s', filename, reader.line_num, e)
             sys.exit(EXIT_STATUS_PREDICTIONS_MALFORMED)
 
-    return predictions
+    return dict(zip(predictions.keys(), tokenize_batch(list(predictions.values()), tokenizer)))
 
 
-def main():
+# name -> (type, help) of every metric an evaluation run records
+METRIC_TYPES = collections.OrderedDict([
+    ('semeval_parse_seconds', ('histogram', 'Time spent reading the gold and submission files.')),
+    ('semeval_score_seconds', ('histogram', 'Time spent computing the metrics of a subtask.')),
+    ('semeval_rows_total', ('counter', 'Submission rows scored.')),
+    ('semeval_rows_per_second', ('gauge', 'Submission rows read and scored per second in the last run.')),
+    ('semeval_submissions_total', ('counter', 'Submission files scored successfully.')),
+    ('semeval_gold_cache_total', ('counter', 'Lookups of the tokenized reference cache, by result.')),
+    ('semeval_errors_total', ('counter', 'Failed evaluations, by exit status.')),
+])
 
-    input_dir = sys.argv[1]
-    output_dir = sys.argv[2]
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+
+def exit_status_name(code) -> str:
+    for name, value in globals().items():
+        if name.startswith('EXIT_STATUS_') and value == code:
+            return name[len('EXIT_STATUS_'):]
+    return str(code)
+
+
+class MetricsRegistry(object):
+    """Counters, gauges and latency histograms of one evaluation run. Every
+    series is keyed by its metric name and its Prometheus label string, which
+    keeps recording down to a dictionary update."""
+
+    def __init__(self):
+        self.values = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _labels(labels: Dict[str, str]) -> str:
+        return ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, self._labels(labels))
+        self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        self.values[name, self._labels(labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, self._labels(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            # one count per bucket plus +Inf, then the sum of observations
+            histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[len(LATENCY_BUCKETS)] += 1
+        histogram[-1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def state(self) -> Dict[str, list]:
+        return {'values': [[name, labels, value] for (name, labels), value in self.values.items()],
+                'histograms': [[name, labels, h] for (name, labels), h in self.histograms.items()]}
+
+    def merge(self, state: Dict[str, list]):
+        """Adds a state of another registry to this one; gauges take the new value."""
+        for name, labels, value in state['values']:
+            if METRIC_TYPES[name][0] == 'gauge':
+                self.values[name, labels] = value
+            else:
+                self.values[name, labels] = self.values.get((name, labels), 0) + value
+        for name, labels, histogram in state['histograms']:
+            current = self.histograms.setdefault((name, labels), [0] * len(histogram))
+            for i, value in enumerate(histogram):
+                current[i] += value
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for name, (metric_type, help_text) in METRIC_TYPES.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for (series, labels), value in sorted(self.values.items()):
+                if series == name:
+                    lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+            for (series, labels), histogram in sorted(self.histograms.items()):
+                if series != name:
+                    continue
+                prefix = labels + ',' if labels else ''
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], histogram):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{labels}}} {histogram[-1]}')
+                lines.append(f'{name}_count{{{labels}}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+
+
+def write_metrics(metrics_dir: str):
+    """Adds the metrics of this run to the totals in `metrics_dir`/metrics.json
+    and rewrites the Prometheus textfile `metrics_dir`/evaluate.prom from them.
+    Concurrent runs are serialized with a lock file; both files are replaced
+    atomically, so a scraper never sees a partial file."""
+    import fcntl
+
+    os.makedirs(metrics_dir, exist_ok=True)
+    state_file = os.path.join(metrics_dir, 'metrics.json')
+    with open(os.path.join(metrics_dir, 'metrics.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        totals = MetricsRegistry()
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                totals.merge(json.load(f))
+        totals.merge(METRICS.state())
+        for filename, content in [(state_file, json.dumps(totals.state())),
+                                  (os.path.join(metrics_dir, 'evaluate.prom'), totals.to_prometheus())]:
+            with open(filename + '.tmp', 'w') as f:
+                f.write(content)
+            os.replace(filename + '.tmp', filename)
+
+
+def score_taskAB(gold_labels_file: str, submission_file: str,
+                 labels: List[str], prefix: str) -> List[Tuple[str, float]]:
+    start = time.perf_counter()
+    with METRICS.timer('semeval_parse_seconds', subtask=prefix):
+        gold_labels = read_gold_taskAB(gold_labels_file)
+        scored = is_scored_predictions(submission_file, labels)
+        if scored:
+            predictions = read_scored_predictions_taskAB(submission_file, labels)
+        else:
+            predictions = read_predictions_taskAB(submission_file)
+    rows = len(predictions)
+    with METRICS.timer('semeval_score_seconds', subtask=prefix):
+        if scored:
+            metrics = calculate_ranking_metrics(gold_labels, predictions, labels)
+            lines = [(f'{prefix}_Accuracy', metrics['Accuracy'] * 100),
+                     (f'{prefix}_MRR', metrics['MRR'] * 100),
+                     (f'{prefix}_LogLoss', metrics['LogLoss']),
+                     (f'{prefix}_ECE', metrics['ECE'] * 100)]
+        else:
+            accuracy = calculate_accuracy(gold_labels, predictions)
+            lines = [(f'{prefix}_Accuracy', accuracy * 100)]
+    record_rows(prefix, rows, time.perf_counter() - start)
+    return lines
+
+
+# the scoring functions take the subtask C options as keyword arguments,
+# subtasks A and B ignore them
+def score_taskA(gold_labels_file: str, submission_file: str, **options) -> List[Tuple[str, float]]:
+    return score_taskAB(gold_labels_file, submission_file, LABELS_TASKA, 'A')
+
+
+def score_taskB(gold_labels_file: str, submission_file: str, **options) -> List[Tuple[str, float]]:
+    return score_taskAB(gold_labels_file, submission_file, LABELS_TASKB, 'B')
+
+
+def score_taskC(gold_reference_file: str, submission_file: str, tokenizer: str = 'whitespace',
+                cache_dir: Optional[str] = None, long_references: bool = False) -> List[Tuple[str, float]]:
+    start = time.perf_counter()
+    with METRICS.timer('semeval_parse_seconds', subtask='C'):
+        references = read_references_taskC(gold_reference_file, tokenizer, cache_dir, long_references)
+        predictions = read_predictions_taskC(submission_file, tokenizer)
+    rows = len(predictions)
+    with METRICS.timer('semeval_score_seconds', subtask='C'):
+        bleu = calculate_bleu(references, predictions, max_order=4, smooth=False)
+    record_rows('C', rows, time.perf_counter() - start)
+    return [('C_BLEU', bleu * 100)]
+
+
+def record_rows(subtask: str, rows: int, seconds: float):
+    METRICS.inc('semeval_rows_total', rows, subtask=subtask)
+    METRICS.inc('semeval_submissions_total', subtask=subtask)
+    if seconds > 0:
+        METRICS.set('semeval_rows_per_second', rows / seconds, subtask=subtask)
+
+
+# subtask -> (submission file, gold file, score name, scoring function)
+SUBTASKS = collections.OrderedDict([
+    ('A', ('subtaskA_answers.csv', 'subtaskA_gold_answers.csv', 'A_Accuracy', score_taskA)),
+    ('B', ('subtaskB_answers.csv', 'subtaskB_gold_answers.csv', 'B_Accuracy', score_taskB)),
+    ('C', ('subtaskC_answers.csv', 'subtaskC_gold_answers.csv', 'C_BLEU', score_taskC)),
+])
+
+
+def _count_lines(filename: str, limit: int) -> int:
+    """Counts the lines of a file, reading it in blocks and stopping once
+    more than `limit` lines have been seen."""
+    lines = 0
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            lines += block.count(b'\n')
+            if lines > limit:
+                break
+    return lines
+
+
+# resource limits of guarded mode
+GuardLimits = collections.namedtuple('GuardLimits', [
+    'cpu_seconds', 'max_memory_mb', 'max_field_size', 'max_size_ratio', 'size_slack', 'line_slack'])
+
+
+def _longest_field(filename: str, max_size: int) -> int:
+    """Returns the length of the longest csv field of a file of at most
+    `max_size` bytes, or -1 if the file is not valid csv."""
+    previous_limit = csv.field_size_limit()
+    csv.field_size_limit(max(max_size, previous_limit))
+    longest = 0
+    try:
+        with open(filename, "rt", encoding="UTF-8", errors="replace") as f:
+            for row in csv.reader(f):
+                longest = max(longest, max(map(len, row), default=0))
+    except csv.Error:
+        return -1
+    finally:
+        csv.field_size_limit(previous_limit)
+    return longest
+
+
+def _address_space_mb() -> int:
+    """Returns the address space the current process already takes, in MB,
+    or 0 where /proc is not available."""
+    try:
+        with open('/proc/self/status', 'rt') as f:
+            for line in f:
+                if line.startswith('VmSize:'):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def precheck_submission(gold_file: str, submission_file: str, limits: GuardLimits) -> bool:
+    """Rejects submissions that are much larger than their gold file, or hold a
+    field longer than the csv field limit, before they are scored. Files that
+    are not valid csv pass, their scorer reports them."""
+    gold_size = os.path.getsize(gold_file)
+    max_size = limits.max_size_ratio * gold_size + limits.size_slack
+    size = os.path.getsize(submission_file)
+    if size > max_size:
+        logging.error("Submission %s is %d bytes, the limit for this subtask is %d bytes",
+                      submission_file, size, max_size)
+        return False
+
+    max_lines = limits.max_size_ratio * _count_lines(gold_file, sys.maxsize) + limits.line_slack
+    lines = _count_lines(submission_file, max_lines)
+    if lines > max_lines:
+        logging.error("Submission %s has more than %d lines", submission_file, max_lines)
+        return False
+
+    # the size checks above bound the memory this full parse can take
+    if _longest_field(submission_file, max_size) > limits.max_field_size:
+        logging.error("Submission %s has a field longer than %d characters",
+                      submission_file, limits.max_field_size)
+        return False
+
+    return True
+
+
+def _guarded_worker(conn, score_function, gold_file: str, submission_file: str,
+                    options: Dict[str, object], limits: GuardLimits):
+    """Scores one subtask under CPU-time, address-space and csv field size limits.
+    Exceeding the CPU limit kills the process with SIGXCPU; running out of memory
+    exits with EXIT_STATUS_RESOURCE_LIMIT. Scoring errors keep their own exit status,
+    unexpected exceptions exit with EXIT_STATUS_SCORER_ERROR. Everything the worker
+    needs is passed in, so it also runs under the spawn and forkserver start methods."""
+    import resource
+
+    # only the metrics of this subtask are sent back to the parent
+    global METRICS
+    METRICS = MetricsRegistry()
+    resource.setrlimit(resource.RLIMIT_CPU, (limits.cpu_seconds, limits.cpu_seconds + 1))
+    memory = limits.max_memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    csv.field_size_limit(limits.max_field_size)
+
+    try:
+        score = score_function(gold_file, submission_file, **options)
+    except MemoryError:
+        logging.error("Scoring %s exceeded the memory limit of %d MB",
+                      submission_file, limits.max_memory_mb)
+        sys.exit(EXIT_STATUS_RESOURCE_LIMIT)
+    except Exception:
+        logging.exception("Scoring %s failed", submission_file)
+        sys.exit(EXIT_STATUS_SCORER_ERROR)
+    conn.send((score, METRICS.state()))
+    conn.close()
+
+
+def score_guarded(truth_dir: str, submit_dir: str, subtasks: List[str], options: Dict[str, object],
+                  limits: GuardLimits) -> Tuple[Dict[str, List[Tuple[str, float]]], int]:
+    """Scores every subtask in its own resource-limited worker process, all at
+    the same time, so that one over-budget submission cannot hold back the
+    others. Returns the scores of the subtasks that succeeded and the exit
+    status of the first one that failed (0 if none did)."""
+    import multiprocessing
+
+    statuses = {}
+    workers = {}
+    for subtask in subtasks:
+        submission_name, gold_name, _, score_function = SUBTASKS[subtask]
+        gold_file = os.path.join(truth_dir, gold_name)
+        submission_file = os.path.join(submit_dir, submission_name)
+        if not precheck_submission(gold_file, submission_file, limits):
+            statuses[subtask] = EXIT_STATUS_RESOURCE_LIMIT
+            continue
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_guarded_worker,
+                                          args=(child_conn, score_function, gold_file, submission_file,
+                                                options, limits))
+        process.start()
+        child_conn.close()
+        workers[subtask] = (process, parent_conn)
+
+    # the CPU limit is enforced by the kernel, the wall-clock deadline only
+    # catches workers that are blocked rather than busy
+    deadline = time.monotonic() + 2 * limits.cpu_seconds + 5
+    scores = {}
+    for subtask, (process, conn) in workers.items():
+        if conn.poll(max(deadline - time.monotonic(), 0)):
+            try:
+                scores[subtask], state = conn.recv()
+                METRICS.merge(state)
+            except EOFError:
+                pass
+        process.join(max(deadline - time.monotonic(), 0))
+        if process.is_alive():
+            process.kill()
+            process.join()
+            logging.error("Scoring subtask %s did not finish in time", subtask)
+            statuses[subtask] = EXIT_STATUS_RESOURCE_LIMIT
+        elif process.exitcode < 0:
+            # killed by a signal, i.e. SIGXCPU or SIGKILL for exceeding the CPU limit
+            logging.error("Scoring subtask %s exceeded the CPU limit of %d seconds",
+                          subtask, limits.cpu_seconds)
+            statuses[subtask] = EXIT_STATUS_RESOURCE_LIMIT
+        elif process.exitcode > 0:
+            statuses[subtask] = process.exitcode
+        if subtask in statuses:
+            scores.pop(subtask, None)
+            METRICS.inc('semeval_errors_total', subtask=subtask,
+                        status=exit_status_name(statuses[subtask]))
+
+    status = next((statuses[s] for s in subtasks if s in statuses), 0)
+    return scores, status
+
+
+def evaluate(args: argparse.Namespace):
+
+    input_dir = args.input_dir
+    output_dir = args.output_dir
 
     submit_dir = os.path.join(input_dir, 'res')
     truth_dir = os.path.join(input_dir, 'ref')
@@ -332,56 +968,102 @@ def main():
         output_filename = os.path.join(output_dir, 'scores.txt')
         output_file = open(output_filename, 'w')
 
-        taskA_file = 'subtaskA_answers.csv'
-        taskB_file = 'subtaskB_answers.csv'
-        taskC_file = 'subtaskC_answers.csv'
-
         submission_files = os.listdir(submit_dir)
         submission_files = [f for f in submission_files if f != '.DS_Store']
         if not submission_files:
             logging.error("No files found in submission dir!")
+            METRICS.inc('semeval_errors_total', status=exit_status_name(EXIT_STATUS_WRONG_FILE))
             sys.exit(EXIT_STATUS_WRONG_FILE)
 
+        valid_files = [submission_name for submission_name, _, _, _ in SUBTASKS.values()]
         for submission_file in submission_files:
-            if submission_file not in [taskA_file, taskB_file, taskC_file]:
+            if submission_file not in valid_files:
                 logging.error(
                     '%s is not valid submission file name for any subtask!', submission_file)
+                METRICS.inc('semeval_errors_total', status=exit_status_name(EXIT_STATUS_WRONG_FILE))
                 sys.exit(EXIT_STATUS_WRONG_FILE)
-        if taskA_file in submission_files:
-            gold_labels_file = os.path.join(
-                truth_dir, "subtaskA_gold_answers.csv")
-            gold_labels = read_gold_taskAB(gold_labels_file)
-            submission_file = os.path.join(submit_dir, taskA_file)
-            pred_labels = read_predictions_taskAB(submission_file)
-            accuracy = calculate_accuracy(gold_labels, pred_labels)
-            output_file.write(f'A_Accuracy: {accuracy*100:.4f}\n')
-        else:
-            output_file.write(f'A_Accuracy: 0\n')
-        if taskB_file in submission_files:
-            gold_labels_file = os.path.join(
-                truth_dir, "subtaskB_gold_answers.csv")
-            gold_labels = read_gold_taskAB(gold_labels_file)
-            submission_file = os.path.join(submit_dir, taskB_file)
-            pred_labels = read_predictions_taskAB(submission_file)
-            accuracy = calculate_accuracy(gold_labels, pred_labels)
-            output_file.write(f'B_Accuracy: {accuracy*100:.4f}\n')
-        else:
-            output_file.write(f'B_Accuracy: 0\n')
-        if taskC_file in submission_files:
-            gold_reference_file = os.path.join(
-                truth_dir, "subtaskC_gold_answers.csv")
-            references = read_references_taskC(gold_reference_file)
-            submission_file = os.path.join(submit_dir, taskC_file)
-            predictions = read_predictions_taskC(submission_file)
-
-            bleu = calculate_bleu(references, predictions,
-                                  max_order=4, smooth=False)
-
-            output_file.write(f'C_BLEU: {bleu*100:.4f}\n')
-        else:
-            output_file.write(f'C_BLEU: 0\n')
+        submitted = [subtask for subtask, (submission_name, _, _, _) in SUBTASKS.items()
+                     if submission_name in submission_files]
+
+        options = {'tokenizer': args.tokenizer, 'cache_dir': args.cache_dir,
+                   'long_references': args.long_references}
+        status = 0
+        if args.guarded:
+            limits = GuardLimits(args.cpu_seconds, args.max_memory_mb, args.max_field_size,
+                                 args.max_size_ratio, args.size_slack, args.line_slack)
+            # a worker starts out as large as this process, below that it could
+            # not allocate anything and would only fail once the CPU limit hits
+            address_space = _address_space_mb()
+            if limits.max_memory_mb <= address_space:
+                logging.error("The memory limit of %d MB is not above the %d MB the scoring "
+                              "program already takes", limits.max_memory_mb, address_space)
+                METRICS.inc('semeval_errors_total', status=exit_status_name(EXIT_STATUS_RESOURCE_LIMIT))
+                sys.exit(EXIT_STATUS_RESOURCE_LIMIT)
+            scores, status = score_guarded(truth_dir, submit_dir, submitted, options, limits)
+
+        for subtask, (submission_name, gold_name, score_name, score_function) in SUBTASKS.items():
+            if subtask not in submitted:
+                output_file.write(f'{score_name}: 0\n')
+                continue
+            if args.guarded:
+                if subtask not in scores:
+                    continue
+                lines = scores[subtask]
+            else:
+                try:
+                    lines = score_function(os.path.join(truth_dir, gold_name),
+                                           os.path.join(submit_dir, submission_name), **options)
+                except SystemExit as e:
+                    METRICS.inc('semeval_errors_total', subtask=subtask, status=exit_status_name(e.code))
+                    raise
+            for name, score in lines:
+                output_file.write(f'{name}: {score:.4f}\n')
 
         output_file.close()
+        if status:
+            sys.exit(status)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='SemEval 2020 Task 4 scoring program')
+    parser.add_argument('input_dir', help='directory with the res/ and ref/ subdirectories')
+    parser.add_argument('output_dir', help='directory to write scores.txt to')
+    parser.add_argument('--tokenizer', default='whitespace', choices=TOKENIZERS,
+                        help='tokenization applied to subtask C references and predictions')
+    parser.add_argument('--cache-dir',
+                        help='directory to cache tokenized subtask C references in')
+    parser.add_argument('--long-references', action='store_true',
+                        help='subtask C gold file has one id,reference row per reference')
+    parser.add_argument('--guarded', action='store_true',
+                        help='score untrusted submissions under resource limits, '
+                             'each subtask in its own worker process')
+    parser.add_argument('--cpu-seconds', type=int, default=60,
+                        help='CPU time limit per subtask in guarded mode')
+    parser.add_argument('--max-memory-mb', type=int, default=1024,
+                        help='address space limit per subtask in guarded mode')
+    parser.add_argument('--max-field-size', type=int, default=64 * 1024,
+                        help='maximum length of a csv field in guarded mode')
+    parser.add_argument('--max-size-ratio', type=int, default=10,
+                        help='maximum size and line count of a submission, '
+                             'relative to its gold file, in guarded mode')
+    parser.add_argument('--size-slack', type=int, default=1024 * 1024,
+                        help='bytes allowed on top of the size ratio in guarded mode')
+    parser.add_argument('--line-slack', type=int, default=1000,
+                        help='lines allowed on top of the line count ratio in guarded mode')
+    parser.add_argument('--metrics-dir',
+                        help='directory to accumulate run metrics in, as metrics.json and '
+                             'a Prometheus textfile evaluate.prom')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    try:
+        evaluate(args)
+    finally:
+        if args.metrics_dir:
+            write_metrics(args.metrics_dir)
 
 
 if __name__ == '__main__':